@@ -1,4 +1,4 @@
-from collections import Iterable
+from collections.abc import Iterable
 from heapq import heapify, heappushpop, _siftdown_max, _siftup_max, heappop, heappush, _heapify_max, _heappop_max
 
 
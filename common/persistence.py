@@ -1,26 +1,45 @@
+import json
+import mmap
 import os
 import pickle
 import shutil
+import struct
+
+import numpy as np
 from lsm import LSM
 
 
+def encode_key(key):
+    # node ids are stored as 8-byte big-endian integers behind a NUL byte, which no string key starts with
+    if isinstance(key, str):
+        return str.encode(key)
+    return b'\0' + int(key).to_bytes(8, 'big')
+
+
 class PersistentDict:
     def __init__(self, *args, **kwargs):
         path = args[0]
-        self.lsm = LSM(path)
+        self.readonly = kwargs.get('readonly', False)
+        self.lsm = LSM(path, readonly=self.readonly)
         self.lsm.open()
 
     def __setitem__(self, key, value):
-        self.lsm[str.encode(key)] = pickle.dumps(value)
+        self.lsm[encode_key(key)] = pickle.dumps(value)
 
     def __getitem__(self, key):
-        return pickle.loads(self.lsm[str.encode(key)])
+        return pickle.loads(self.lsm[encode_key(key)])
+
+    def set_bytes(self, key, value):
+        self.lsm[encode_key(key)] = value
+
+    def get_bytes(self, key):
+        return self.lsm[encode_key(key)]
 
     def __contains__(self, key):
-        return str.encode(key) in self.lsm
+        return encode_key(key) in self.lsm
 
     def __delitem__(self, key):
-        del self.lsm[str.encode(key)]
+        del self.lsm[encode_key(key)]
 
     @staticmethod
     def copy(src_path, dest_path):
@@ -32,3 +51,76 @@ class PersistentDict:
 
     def close(self):
         self.lsm.close()
+
+
+class FrozenArrays:
+    # Read-only file of named numpy arrays, memory-mapped so that every process opening it shares the OS page cache.
+    # Layout: MAGIC, the length of a JSON header, the header (properties and the dtype, shape and offset of every
+    # array), then the arrays, each aligned to ALIGNMENT bytes.
+    MAGIC = b'FROZENIX'
+    ALIGNMENT = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header_len, = struct.unpack_from('<Q', self.mmap, len(self.MAGIC))
+        start = len(self.MAGIC) + 8
+        header = json.loads(self.mmap[start:start + header_len].decode())
+        self.properties = header['properties']
+        self.arrays = dict()
+        for name, (dtype, shape, offset) in header['arrays'].items():
+            count = int(np.prod(shape))
+            self.arrays[name] = np.frombuffer(self.mmap, dtype, count, offset).reshape(shape)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __setitem__(self, key, value):
+        self.read_only()
+
+    def __delitem__(self, key):
+        self.read_only()
+
+    def set_bytes(self, key, value):
+        self.read_only()
+
+    def read_only(self):
+        raise ValueError(f'{self.path} is a frozen index and cannot be modified')
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    @staticmethod
+    def is_frozen(path):
+        if not os.path.isfile(path):
+            return False
+        with open(path, 'rb') as f:
+            return f.read(len(FrozenArrays.MAGIC)) == FrozenArrays.MAGIC
+
+    @staticmethod
+    def write(path, properties, arrays):
+        arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+        layout = dict()
+        header = b''
+        # the header length depends on the offsets, grow the reserved space until the layout fits
+        reserved = 4096
+        while True:
+            offset = reserved
+            for name, a in arrays.items():
+                layout[name] = (a.dtype.str, list(a.shape), offset)
+                offset += -(-a.nbytes // FrozenArrays.ALIGNMENT) * FrozenArrays.ALIGNMENT
+            header = json.dumps({'properties': properties, 'arrays': layout}).encode()
+            if len(FrozenArrays.MAGIC) + 8 + len(header) <= reserved:
+                break
+            reserved *= 2
+        with open(path, 'wb') as f:
+            f.write(FrozenArrays.MAGIC + struct.pack('<Q', len(header)) + header)
+            for name, a in arrays.items():
+                f.seek(layout[name][2])
+                f.write(a.tobytes())
+            f.truncate(offset)
+
+    def close(self):
+        self.arrays.clear()
+        self.mmap.close()
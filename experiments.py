@@ -164,10 +164,25 @@ def create_index(name, distribution=None, n=None):
     index.close()
 
 
-def load_index(name, distribution=None, n=None):
+def freeze_index(name, distribution=None, n=None):
+    index = load_index(name, distribution, n)
+    index.freeze(frozen_path(name, distribution, n))
+    index.close()
+
+
+def frozen_path(name, distribution=None, n=None):
     path = name + '-' + distribution
     if n is not None:
         path += '-' + str(n)
+    return path + '-frozen'
+
+
+def load_index(name, distribution=None, n=None, frozen=False):
+    path = name + '-' + distribution
+    if n is not None:
+        path += '-' + str(n)
+    if frozen:
+        path = frozen_path(name, distribution, n)
     return VoRtreeIndex(path=path)
 
 
@@ -242,7 +257,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(vr.MonoRkNN(facility_index.nodes[i], k, facility_index))
+                    list(vr.MonoRkNN(facility_index.lookup(i), k, facility_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     io_cost.append(st.io_count)
@@ -259,7 +274,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(slice.MonoRkNN(facility_index.nodes[i], k, facility_index))
+                    list(slice.MonoRkNN(facility_index.lookup(i), k, facility_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     io_cost.append(st.io_count)
@@ -276,7 +291,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(csd.MonoRkNN(facility_index.nodes[i], k, facility_index))
+                    list(csd.MonoRkNN(facility_index.lookup(i), k, facility_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     io_cost.append(st.io_count)
@@ -333,7 +348,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(vr.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(vr.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -353,7 +368,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(slice.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(slice.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -373,7 +388,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(csd.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(csd.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -430,7 +445,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(vr.MonoRkNN(facility_index.nodes[i], k, facility_index))
+                    list(vr.MonoRkNN(facility_index.lookup(i), k, facility_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     io_cost.append(st.io_count)
@@ -447,7 +462,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(slice.MonoRkNN(facility_index.nodes[i], k, facility_index))
+                    list(slice.MonoRkNN(facility_index.lookup(i), k, facility_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     io_cost.append(st.io_count)
@@ -464,7 +479,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, data_size)
                     st = Statistics()
                     st.reset()
-                    list(csd.MonoRkNN(facility_index.nodes[i], k, facility_index))
+                    list(csd.MonoRkNN(facility_index.lookup(i), k, facility_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     io_cost.append(st.io_count)
@@ -523,7 +538,7 @@ class BenchmarkExperiments:
                     user_index = create_temp_index_copy('User', distribution, user_data_size)
                     st = Statistics()
                     st.reset()
-                    list(vr.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(vr.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     user_index.close()
@@ -543,7 +558,7 @@ class BenchmarkExperiments:
                     user_index = create_temp_index_copy('User', distribution, user_data_size)
                     st = Statistics()
                     st.reset()
-                    list(slice.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(slice.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     user_index.close()
@@ -563,7 +578,7 @@ class BenchmarkExperiments:
                     user_index = create_temp_index_copy('User', distribution, user_data_size)
                     st = Statistics()
                     st.reset()
-                    list(csd.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(csd.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     facility_index.close()
                     user_index.close()
@@ -587,6 +602,55 @@ class BenchmarkExperiments:
             io_v['y_label'] = '# I/O'
             return time_v, io_v
 
+    @staticmethod
+    def evaluate_effect_of_partition_num_on_MonoRkNN(k, distribution, times=None):
+        # VR needs at least 6 partitions, so its bars start there, and has no adaptive count, so its 'auto' bar repeats
+        # its default of 6; CSD does not partition and is repeated as a baseline
+        if times is None:
+            times = default_times
+        partition_nums = [6, 8, 12, 16, 'auto']
+        vr_partition_nums = [6 if n == 'auto' else n for n in partition_nums]
+        if distribution == 'Real':
+            data_size = 87901
+        else:
+            data_size = 100000
+        q_ids = random_ids(times, 'Facility', distribution, data_size)
+        costs = dict()
+        for algorithm, partition_num in [(vr, n) for n in sorted(set(vr_partition_nums))] + \
+                                        [(slice, n) for n in partition_nums] + [(csd, None)]:
+            time_cost = []
+            io_cost = []
+            for i in q_ids:
+                facility_index = create_temp_index_copy('Facility', distribution, data_size)
+                kwargs = dict() if partition_num is None else {'partition_num': partition_num}
+                st = Statistics()
+                st.reset()
+                list(algorithm.MonoRkNN(facility_index.lookup(i), k, facility_index, **kwargs))
+                time_cost.append(st.time_elapse)
+                facility_index.close()
+                io_cost.append(st.io_count)
+                facility_index.drop_file()
+            costs[(algorithm, partition_num)] = (
+                {'mean': round(np.mean(time_cost), 2), 'median': round(np.median(time_cost), 2),
+                 'std': np.std(time_cost)},
+                {'mean': round(np.mean(io_cost), 1), 'median': round(np.median(io_cost), 1),
+                 'std': round(np.std(io_cost), 1)})
+        time_v = dict()
+        time_v['data'] = {'VR': [costs[(vr, n)][0] for n in vr_partition_nums],
+                          'SLICE': [costs[(slice, n)][0] for n in partition_nums],
+                          'CSD': [costs[(csd, None)][0] for n in partition_nums]}
+        time_v['x_tick_labels'] = partition_nums
+        time_v['x_label'] = '# Partitions'
+        time_v['y_label'] = 'Time cost (in sec)'
+        io_v = dict()
+        io_v['data'] = {'VR': [costs[(vr, n)][1] for n in vr_partition_nums],
+                        'SLICE': [costs[(slice, n)][1] for n in partition_nums],
+                        'CSD': [costs[(csd, None)][1] for n in partition_nums]}
+        io_v['x_tick_labels'] = partition_nums
+        io_v['x_label'] = '# Partitions'
+        io_v['y_label'] = '# I/O'
+        return time_v, io_v
+
     @staticmethod
     def evaluate_effect_of_data_distribution(k, times=None):
         if times is None:
@@ -611,7 +675,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', facility_distribution, facility_data_size)
                     st = Statistics()
                     st.reset()
-                    list(vr.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(vr.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -631,7 +695,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', facility_distribution, facility_data_size)
                     st = Statistics()
                     st.reset()
-                    list(slice.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(slice.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -651,7 +715,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', facility_distribution, facility_data_size)
                     st = Statistics()
                     st.reset()
-                    list(csd.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(csd.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -711,7 +775,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, facility_data_size)
                     st = Statistics()
                     st.reset()
-                    list(vr.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(vr.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -731,7 +795,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, facility_data_size)
                     st = Statistics()
                     st.reset()
-                    list(slice.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(slice.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -751,7 +815,7 @@ class BenchmarkExperiments:
                     facility_index = create_temp_index_copy('Facility', distribution, facility_data_size)
                     st = Statistics()
                     st.reset()
-                    list(csd.BiRkNN(facility_index.nodes[i], k, facility_index, user_index))
+                    list(csd.BiRkNN(facility_index.lookup(i), k, facility_index, user_index))
                     time_cost.append(st.time_elapse)
                     user_index.close()
                     facility_index.close()
@@ -799,7 +863,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(vr.BiRkNN(educational_institution_index.nodes[i], k, educational_institution_index,
+                list(vr.BiRkNN(educational_institution_index.lookup(i), k, educational_institution_index,
                                residential_district_index))
                 time_cost.append(st.time_elapse)
                 educational_institution_index.close()
@@ -820,7 +884,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(slice.BiRkNN(educational_institution_index.nodes[i], k, educational_institution_index,
+                list(slice.BiRkNN(educational_institution_index.lookup(i), k, educational_institution_index,
                                   residential_district_index))
                 time_cost.append(st.time_elapse)
                 educational_institution_index.close()
@@ -841,7 +905,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(csd.BiRkNN(educational_institution_index.nodes[i], k, educational_institution_index,
+                list(csd.BiRkNN(educational_institution_index.lookup(i), k, educational_institution_index,
                                 residential_district_index))
                 time_cost.append(st.time_elapse)
                 educational_institution_index.close()
@@ -887,7 +951,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(vr.BiRkNN(mall_index.nodes[i], k, mall_index, residential_district_index))
+                list(vr.BiRkNN(mall_index.lookup(i), k, mall_index, residential_district_index))
                 time_cost.append(st.time_elapse)
                 mall_index.close()
                 residential_district_index.close()
@@ -907,7 +971,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(slice.BiRkNN(mall_index.nodes[i], k, mall_index, residential_district_index))
+                list(slice.BiRkNN(mall_index.lookup(i), k, mall_index, residential_district_index))
                 time_cost.append(st.time_elapse)
                 mall_index.close()
                 residential_district_index.close()
@@ -927,7 +991,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(csd.BiRkNN(mall_index.nodes[i], k, mall_index, residential_district_index))
+                list(csd.BiRkNN(mall_index.lookup(i), k, mall_index, residential_district_index))
                 time_cost.append(st.time_elapse)
                 mall_index.close()
                 residential_district_index.close()
@@ -972,7 +1036,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(vr.BiRkNN(medical_institution_index.nodes[i], k, medical_institution_index,
+                list(vr.BiRkNN(medical_institution_index.lookup(i), k, medical_institution_index,
                                residential_district_index))
                 time_cost.append(st.time_elapse)
                 medical_institution_index.close()
@@ -993,7 +1057,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(slice.BiRkNN(medical_institution_index.nodes[i], k, medical_institution_index,
+                list(slice.BiRkNN(medical_institution_index.lookup(i), k, medical_institution_index,
                                   residential_district_index))
                 time_cost.append(st.time_elapse)
                 medical_institution_index.close()
@@ -1014,7 +1078,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(csd.BiRkNN(medical_institution_index.nodes[i], k, medical_institution_index,
+                list(csd.BiRkNN(medical_institution_index.lookup(i), k, medical_institution_index,
                                 residential_district_index))
                 time_cost.append(st.time_elapse)
                 medical_institution_index.close()
@@ -1060,7 +1124,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(vr.BiRkNN(restaurant_index.nodes[i], k, restaurant_index, residential_district_index))
+                list(vr.BiRkNN(restaurant_index.lookup(i), k, restaurant_index, residential_district_index))
                 time_cost.append(st.time_elapse)
                 restaurant_index.close()
                 residential_district_index.close()
@@ -1080,7 +1144,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(slice.BiRkNN(restaurant_index.nodes[i], k, restaurant_index, residential_district_index))
+                list(slice.BiRkNN(restaurant_index.lookup(i), k, restaurant_index, residential_district_index))
                 time_cost.append(st.time_elapse)
                 restaurant_index.close()
                 residential_district_index.close()
@@ -1100,7 +1164,7 @@ class CaseStudyExperiments:
                 residential_district_index = create_temp_index_copy('Residence', 'Wuhan')
                 st = Statistics()
                 st.reset()
-                list(csd.BiRkNN(restaurant_index.nodes[i], k, restaurant_index, residential_district_index))
+                list(csd.BiRkNN(restaurant_index.lookup(i), k, restaurant_index, residential_district_index))
                 time_cost.append(st.time_elapse)
                 restaurant_index.close()
                 residential_district_index.close()
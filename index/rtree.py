@@ -1,44 +1,288 @@
 # -*- coding:utf-8 -*-
-import itertools
-from uuid import uuid1 as generate_uuid
-
-from shapely.geometry import Point, Polygon
+import pickle
+import struct
+import sys
+from array import array
+from collections import OrderedDict
+from itertools import chain
+from math import ceil, sqrt
+
+import numpy as np
+from shapely.geometry import Point, Polygon, box
 from shapely.geometry.base import BaseGeometry
-from shapely.ops import unary_union
+from shapely.prepared import prep
 from tqdm import tqdm
 
 from common.data_structure import MinHeap, NSmallestHolder
 
-from common.persistence import PersistentDict
+from common.persistence import FrozenArrays, PersistentDict
+
+
+# MBRs are (minx, miny, maxx, maxy) tuples of floats, points are degenerate MBRs and an empty node has None.
+def to_bounds(geom):
+    if geom is None or geom.is_empty:
+        return None
+    if isinstance(geom, Point):
+        return geom.x, geom.y, geom.x, geom.y
+    return tuple(geom.bounds)
+
+
+def to_geom(bounds, is_point):
+    if bounds is None:
+        return Polygon()
+    if is_point:
+        return Point(bounds[0], bounds[1])
+    return box(*bounds)
+
+
+def bounding_box(bounds_list):
+    bounds_list = [b for b in bounds_list if b is not None]
+    if len(bounds_list) == 0:
+        return None
+    mbrs = np.asarray(bounds_list, dtype=float)
+    return (float(mbrs[:, 0].min()), float(mbrs[:, 1].min()),
+            float(mbrs[:, 2].max()), float(mbrs[:, 3].max()))
+
+
+def union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])
+
+
+def area(bounds):
+    if bounds is None:
+        return 0.0
+    return (bounds[2] - bounds[0]) * (bounds[3] - bounds[1])
+
+
+def intersects(a, b):
+    if a is None or b is None:
+        return False
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+
+def distance(x1, y1, x2, y2):
+    # same formula as GEOS, so that arithmetic and shapely distances compare exactly
+    dx = x1 - x2
+    dy = y1 - y2
+    return sqrt(dx * dx + dy * dy)
+
+
+def mbr_array(nodes):
+    return np.array([n.bounds for n in nodes], dtype=float).reshape(-1, 4)
+
+
+def mbr_areas(mbrs):
+    return (mbrs[:, 2] - mbrs[:, 0]) * (mbrs[:, 3] - mbrs[:, 1])
+
+
+def mbr_union_areas(mbrs, bounds):
+    return ((np.maximum(mbrs[:, 2], bounds[2]) - np.minimum(mbrs[:, 0], bounds[0])) *
+            (np.maximum(mbrs[:, 3], bounds[3]) - np.minimum(mbrs[:, 1], bounds[1])))
+
+
+def mbr_min_dists(mbrs, x, y):
+    dx = np.maximum(np.maximum(mbrs[:, 0] - x, x - mbrs[:, 2]), 0)
+    dy = np.maximum(np.maximum(mbrs[:, 1] - y, y - mbrs[:, 3]), 0)
+    return np.sqrt(dx * dx + dy * dy)
+
+
+# Node record: header (format version, level, number of coordinates, number of children, number of neighbours,
+# length of the external id), the float64 coordinates of the point or MBR, the int64 child ids, the int64 neighbour
+# ids and the UTF-8 external id. Absent fields are stored with length NONE. Everything is little-endian.
+NODE_FORMAT_VERSION = 2
+NODE_HEADER = struct.Struct('<BBBxIII')
+NONE = 0xFFFFFFFF
+
+
+def new_ids(ids=()):
+    return array('q', ids)
+
+
+def ids_to_bytes(ids):
+    if sys.byteorder == 'big':
+        ids = array('q', ids)
+        ids.byteswap()
+    return ids.tobytes()
+
+
+def ids_from_bytes(data):
+    ids = array('q')
+    ids.frombytes(data)
+    if sys.byteorder == 'big':
+        ids.byteswap()
+    return ids
+
+
+def encode_node(coords, child_ids, level, uuid, neighbor_ids=None):
+    coord_num = 0 if coords is None else len(coords)
+    child_num = NONE if child_ids is None else len(child_ids)
+    neighbor_num = NONE if neighbor_ids is None else len(neighbor_ids)
+    uuid = None if uuid is None else uuid.encode()
+    return b''.join([NODE_HEADER.pack(NODE_FORMAT_VERSION, level, coord_num, child_num, neighbor_num,
+                                      NONE if uuid is None else len(uuid)),
+                     struct.pack(f'<{coord_num}d', *coords) if coord_num > 0 else b'',
+                     ids_to_bytes(child_ids) if child_ids is not None else b'',
+                     ids_to_bytes(neighbor_ids) if neighbor_ids is not None else b'',
+                     uuid or b''])
+
+
+def decode_node(data):
+    if data[0] != NODE_FORMAT_VERSION:
+        raise ValueError(f'unsupported node record format {data[0]}, the index has to be rebuilt')
+    version, level, coord_num, child_num, neighbor_num, uuid_len = NODE_HEADER.unpack_from(data)
+    data = memoryview(data)
+    offset = NODE_HEADER.size
+    coords = struct.unpack_from(f'<{coord_num}d', data, offset) if coord_num > 0 else None
+    offset += 8 * coord_num
+    child_ids = None
+    neighbor_ids = None
+    uuid = None
+    if child_num != NONE:
+        child_ids = ids_from_bytes(data[offset:offset + 8 * child_num])
+        offset += 8 * child_num
+    if neighbor_num != NONE:
+        neighbor_ids = ids_from_bytes(data[offset:offset + 8 * neighbor_num])
+        offset += 8 * neighbor_num
+    if uuid_len != NONE:
+        uuid = bytes(data[offset:offset + uuid_len]).decode()
+    return coords, child_ids, level, uuid, neighbor_ids
+
+
+# Indices written before nodes had integer ids keyed every node by its uuid string, and stored it pickled as
+# (geometry, child uuids, level[, neighbour uuids]) or, in node record format 1, as a '<BBBBII' header (format version,
+# level, number of coordinates, id encoding, number of children, number of neighbours), the float64 coordinates and
+# the NUL-separated child and neighbour uuids. They are not read as indices, legacy_data() gets their points out to
+# rebuild one from.
+LEGACY_NODE_HEADER = struct.Struct('<BBBBII')
+
+
+def decode_legacy_node(data):
+    if data[:1] == b'\x80':
+        geom, child_ids, level = pickle.loads(data)[:3]
+        return geom, child_ids, level
+    version, level, coord_num, id_encoding, child_num, neighbor_num = LEGACY_NODE_HEADER.unpack_from(data)
+    if version != 1:
+        raise ValueError(f'unsupported legacy node record format {version}')
+    offset = LEGACY_NODE_HEADER.size
+    coords = struct.unpack_from(f'<{coord_num}d', data, offset) if coord_num > 0 else None
+    offset += 8 * coord_num
+    ids = data[offset:].decode().split('\0') if len(data) > offset else []
+    geom = None if coords is None else Point(coords[0], coords[1]) if level == 0 else box(*coords)
+    return geom, ids[:child_num] if child_num != NONE else None, level
+
+
+def legacy_data(path):
+    # (uuid, geometry) of every data point of an index written before nodes had integer ids, in the form the data
+    # argument of RtreeIndex and VoRtreeIndex takes
+    database = PersistentDict(path, readonly=True)
+    try:
+        properties = database['properties']
+        if hasattr(properties, 'NEXT_ID'):
+            raise ValueError(f'{path} is not a legacy index')
+        node_ids = [] if properties.ROOT_ID is None else [properties.ROOT_ID]
+        while len(node_ids) > 0:
+            node_id = node_ids.pop()
+            geom, child_ids, level = decode_legacy_node(database.get_bytes(node_id))
+            if level == 0:
+                yield node_id, geom
+            elif child_ids is not None:
+                node_ids += child_ids
+    finally:
+        database.close()
+
+
+def csr(id_lists):
+    # compressed sparse rows: the ids of row i are values[offsets[i]:offsets[i + 1]], a None row is empty
+    counts = np.fromiter((0 if ids is None else len(ids) for ids in id_lists), np.int64, len(id_lists))
+    offsets = np.zeros(len(id_lists) + 1, dtype='<i8')
+    np.cumsum(counts, out=offsets[1:])
+    values = np.fromiter(chain.from_iterable(ids for ids in id_lists if ids is not None), '<i8', int(offsets[-1]))
+    return offsets, values
+
+
+def csr_row(offsets, values, i):
+    return new_ids(values[offsets[i]:offsets[i + 1]].tolist())
+
+
+class NodeArray(list):
+    # in-memory nodes indexed by node id, a deleted node leaves a None hole
+    def __setitem__(self, key, node):
+        if key >= len(self):
+            self.extend([None] * (key + 1 - len(self)))
+        list.__setitem__(self, key, node)
+
+    def __delitem__(self, key):
+        list.__setitem__(self, key, None)
+
+    def __contains__(self, key):
+        return 0 <= key < len(self) and list.__getitem__(self, key) is not None
+
+
+class ExternalIds(object):
+    # node ids of data nodes by the external id they were inserted with, stored next to the nodes
+    PREFIX = 'uuid/'
+
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, uuid):
+        return int.from_bytes(self.database.get_bytes(self.PREFIX + uuid), 'big')
+
+    def __setitem__(self, uuid, node_id):
+        self.database.set_bytes(self.PREFIX + uuid, node_id.to_bytes(8, 'big'))
 
+    def __delitem__(self, uuid):
+        del self.database[self.PREFIX + uuid]
 
-def bounding_box(geoms):
-    return unary_union(geoms).envelope
+    def __contains__(self, uuid):
+        return self.PREFIX + uuid in self.database
 
 
 class NodePool(object):
-    def __init__(self, tree, database):
+    # LRU cache of decoded nodes in front of the database, capacity=None keeps every node loaded
+    def __init__(self, tree, database, capacity=None):
         self.database = database
-        self.cache = dict()
+        self.cache = OrderedDict()
+        self.capacity = capacity
         self.tree = tree
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
     def __delitem__(self, key):
         del self.database[key]
-        del self.cache[key]
+        self.cache.pop(key, None)
 
     def __setitem__(self, key, node):
-        self.database[key] = node.to_data()
-        self.cache[key] = node
+        self.database.set_bytes(key, encode_node(*node.to_data()))
+        self.cache_node(key, node)
 
     def __getitem__(self, key):
         if key in self.cache:
+            self.hits += 1
+            self.cache.move_to_end(key)
             return self.cache[key]
         else:
-            data = self.database[key]
-            node = self.tree.loads(key, data)
-            self.cache[key] = node
+            self.misses += 1
+            node = self.tree.loads(key, self.read(key))
+            self.cache_node(key, node)
             return node
 
+    def read(self, key):
+        return decode_node(self.database.get_bytes(key))
+
+    def cache_node(self, key, node):
+        self.cache[key] = node
+        self.cache.move_to_end(key)
+        if self.capacity is not None:
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
     def __contains__(self, item):
         if item in self.cache:
             return True
@@ -47,16 +291,93 @@ class NodePool(object):
         return False
 
     def reset_cache(self):
-        self.database.reset()
         self.cache.clear()
 
+    def reset_statistics(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def statistics(self):
+        requests = self.hits + self.misses
+        return {'capacity': self.capacity, 'size': len(self.cache), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / requests if requests > 0 else 0.0}
+
+
+class FrozenNodePool(NodePool):
+    # nodes of an index written by RtreeIndex.freeze, read from the memory-mapped arrays
+    def __contains__(self, item):
+        levels = self.database['levels']
+        return item in self.cache or (0 <= item < len(levels) and levels[item] >= 0)
+
+    def read(self, key):
+        if key not in self:
+            raise KeyError(key)
+        arrays = self.database
+        level = int(arrays['levels'][key])
+        bounds = arrays['bounds'][key]
+        bounds = None if np.isnan(bounds[0]) else tuple(bounds.tolist())
+        child_ids = None
+        neighbor_ids = None
+        if level > 0:
+            child_ids = csr_row(arrays['child_offsets'], arrays['child_ids'], key)
+        elif 'neighbor_offsets' in arrays:
+            neighbor_ids = csr_row(arrays['neighbor_offsets'], arrays['neighbor_ids'], key)
+        return bounds, child_ids, level, self.tree.ids.uuid(key), neighbor_ids
+
+
+class FrozenExternalIds(object):
+    # external ids of a frozen index, found by binary search over the node ids sorted by external id
+    def __init__(self, database):
+        self.database = database
+
+    def encoded_uuid(self, node_id):
+        offsets = self.database['uuid_offsets']
+        return self.database['uuids'][offsets[node_id]:offsets[node_id + 1]].tobytes()
+
+    def uuid(self, node_id):
+        uuid = self.encoded_uuid(node_id)
+        return uuid.decode() if len(uuid) > 0 else None
+
+    def find(self, uuid):
+        uuid = uuid.encode()
+        order = self.database['uuid_order']
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.encoded_uuid(order[mid]) < uuid:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(order) and self.encoded_uuid(order[lo]) == uuid:
+            return int(order[lo])
+        return None
+
+    def __getitem__(self, uuid):
+        node_id = self.find(uuid)
+        if node_id is None:
+            raise KeyError(uuid)
+        return node_id
+
+    def __setitem__(self, uuid, node_id):
+        self.database.read_only()
+
+    def __delitem__(self, uuid):
+        self.database.read_only()
+
+    def __contains__(self, uuid):
+        return self.find(uuid) is not None
+
 
 class RtreeIndex(object):
     class Properties:
-        def __init__(self, MAX_CHILDREN_NUM, MIN_CHILDREN_NUM, ROOT_ID):
+        def __init__(self, MAX_CHILDREN_NUM, MIN_CHILDREN_NUM, ROOT_ID, NEXT_ID, VERSION=0):
             self.MAX_CHILDREN_NUM = MAX_CHILDREN_NUM
             self.MIN_CHILDREN_NUM = MIN_CHILDREN_NUM
             self.ROOT_ID = ROOT_ID
+            self.NEXT_ID = NEXT_ID
+            self.VERSION = VERSION
 
     def __init__(self, **kwargs):
         path = kwargs.get('path', None)
@@ -65,15 +386,22 @@ class RtreeIndex(object):
 
         self._database = None
         self._nodes = None
+        self._ids = None
         self._properties = None
         self.path = path
+        self.frozen = path is not None and FrozenArrays.is_frozen(path)
+        self.readonly = kwargs.get('readonly', False) or self.frozen
+        self.cache_size = kwargs.get('cache_size', None)
         data = kwargs.get('data', None)
         if data is not None:
-            with tqdm(total=len(data), unit='item') as bar:
-                bar.set_description('Building R-tree')
-                for uuid, geom in data:
-                    self.insert(uuid, geom)
-                    bar.update()
+            if kwargs.get('bulk_load', False):
+                self.bulk_load(data)
+            else:
+                with tqdm(total=len(data), unit='item') as bar:
+                    bar.set_description('Building R-tree')
+                    for uuid, geom in data:
+                        self.insert(uuid, geom)
+                        bar.update()
 
     def close(self):
         self.database.close()
@@ -84,8 +412,10 @@ class RtreeIndex(object):
     @property
     def database(self):
         if self._database is None:
-            if self.path is not None:
-                self._database = PersistentDict(self.path)
+            if self.path is not None and self.frozen:
+                self._database = FrozenArrays(self.path)
+            elif self.path is not None:
+                self._database = PersistentDict(self.path, readonly=self.readonly)
             else:
                 return None
         return self._database
@@ -97,31 +427,46 @@ class RtreeIndex(object):
     @property
     def nodes(self):
         if self._nodes is None:
-            if self.database is not None:
-                self._nodes = NodePool(self, self.database)
+            if self.frozen:
+                self._nodes = FrozenNodePool(self, self.database, self.cache_size)
+            elif self.database is not None:
+                self._nodes = NodePool(self, self.database, self.cache_size)
             else:
-                self._nodes = dict()
+                self._nodes = NodeArray()
         return self._nodes
 
     @nodes.setter
     def nodes(self, v):
         self._nodes = v
 
+    @property
+    def ids(self):
+        if self._ids is None:
+            if self.frozen:
+                self._ids = FrozenExternalIds(self.database)
+            elif self.database is not None:
+                self._ids = ExternalIds(self.database)
+            else:
+                self._ids = dict()
+        return self._ids
+
+    def lookup(self, uuid):
+        return self.nodes[self.ids[uuid]]
+
     @property
     def properties(self):
         if self._properties is None:
-            if self.database is not None:
-                if 'properties' in self.database:
-                    self._properties = self.database['properties']
-                else:
-                    root = self.new_node('a', Polygon(), [], 1)
-                    root.dumps()
-                    self._properties = RtreeIndex.Properties(self.MAX_CHILDREN_NUM, self.MIN_CHILDREN_NUM, root.uuid)
-                    self.database['properties'] = self._properties
+            if self.frozen:
+                self._properties = RtreeIndex.Properties(**self.database.properties)
+            elif self.database is not None and 'properties' in self.database:
+                self._properties = self.database['properties']
+                if not hasattr(self._properties, 'NEXT_ID'):
+                    raise ValueError(f'{self.path} was written by an earlier version with uuid node keys, rebuild it '
+                                     f'from index.rtree.legacy_data({self.path!r})')
             else:
-                root = self.new_node('a', Polygon(), [], 1)
-                root.dumps()
-                self._properties = RtreeIndex.Properties(self.MAX_CHILDREN_NUM, self.MIN_CHILDREN_NUM, root.uuid)
+                self._properties = RtreeIndex.Properties(self.MAX_CHILDREN_NUM, self.MIN_CHILDREN_NUM, None, 0)
+                if self.database is not None:
+                    self.database['properties'] = self._properties
         return self._properties
 
     @properties.setter
@@ -129,56 +474,174 @@ class RtreeIndex(object):
         self._properties = v
 
     def __contains__(self, item):
-        if type(item) != type(self.root):
+        if not isinstance(item, RtreeNode) or item.tree is not self:
             return False
-        return item.uuid in self.nodes
+        return item.id in self.nodes
+
+    def allocate_ids(self, n=1):
+        first = self.properties.NEXT_ID
+        self.properties.NEXT_ID += n
+        if self.database is not None:
+            self.database['properties'] = self.properties
+        return first
+
+    @property
+    def version(self):
+        # bumped by every insert and delete, properties pickled before versions existed read as version 0
+        return getattr(self.properties, 'VERSION', 0)
+
+    def bump_version(self):
+        self.properties.VERSION = self.version + 1
+        if self.database is not None:
+            self.database['properties'] = self.properties
+
+    def freeze(self, path):
+        # writes a read-only copy of the index that RtreeIndex(path=path) opens memory-mapped
+        if self.properties.ROOT_ID is None:
+            # an empty index creates its root lazily, which a frozen one cannot do
+            self.root.dumps()
+        size = self.properties.NEXT_ID
+        nodes = [self.nodes[i] if i in self.nodes else None for i in range(size)]
+        FrozenArrays.write(path, vars(self.properties), self.frozen_arrays(nodes))
+
+    def frozen_arrays(self, nodes):
+        levels = np.array([-1 if n is None else n.level for n in nodes], dtype='<i1')
+        bounds = np.array([(np.nan,) * 4 if n is None or n.bounds is None else n.bounds for n in nodes],
+                          dtype='<f8').reshape(-1, 4)
+        child_offsets, child_ids = csr([None if n is None else n.child_ids for n in nodes])
+        uuids = [b'' if n is None or n.uuid is None else n.uuid.encode() for n in nodes]
+        uuid_offsets = np.zeros(len(nodes) + 1, dtype='<i8')
+        np.cumsum([len(uuid) for uuid in uuids], out=uuid_offsets[1:])
+        uuid_order = sorted((i for i, uuid in enumerate(uuids) if len(uuid) > 0), key=lambda i: uuids[i])
+        return {'levels': levels, 'bounds': bounds, 'child_offsets': child_offsets, 'child_ids': child_ids,
+                'uuid_offsets': uuid_offsets, 'uuids': np.frombuffer(b''.join(uuids), dtype=np.uint8),
+                'uuid_order': np.array(uuid_order, dtype='<i8')}
 
     def reset_cache(self):
-        self.nodes.reset_cache()
+        if isinstance(self.nodes, NodePool):
+            self.nodes.reset_cache()
+
+    @property
+    def cache_statistics(self):
+        if isinstance(self.nodes, NodePool):
+            return self.nodes.statistics
+        return None
 
     @property
     def root(self):
+        if self.properties.ROOT_ID is None:
+            root = self.new_node(self.allocate_ids(), None, new_ids(), 1)
+            root.dumps()
+            self.root = root
+            return root
         return self.nodes[self.properties.ROOT_ID]
 
     @root.setter
     def root(self, root_node):
-        self.properties.ROOT_ID = root_node.uuid
+        self.properties.ROOT_ID = root_node.id
         if self.database is not None:
             self.database['properties'] = self.properties
 
-    def new_node(self, uuid, geom, child_ids, level):
-        node = RtreeNode(self, uuid, geom, child_ids, level)
+    def new_node(self, node_id, bounds, child_ids, level, uuid=None):
+        node = RtreeNode(self, node_id, bounds, child_ids, level, uuid)
+        return node
+
+    @staticmethod
+    def loads_bounds(coords):
+        if coords is not None and len(coords) == 2:
+            return coords[0], coords[1], coords[0], coords[1]
+        return coords
+
+    def loads(self, node_id, data):
+        return self.new_node(node_id, self.loads_bounds(data[0]), data[1], data[2], data[3])
+
+    def new_data_node(self, uuid, geom, node_id=None):
+        if node_id is None:
+            node_id = self.allocate_ids()
+        node = self.new_node(node_id, to_bounds(geom), None, 0, uuid)
+        node.geom = geom
         return node
 
-    def loads(self, uuid, data):
-        return self.new_node(uuid, data[0], data[1], data[2])
+    def new_data_nodes(self, data):
+        first = self.allocate_ids(len(data))
+        return [self.new_data_node(uuid, geom, first + i) for i, (uuid, geom) in enumerate(data)]
 
     def create_data_node(self, uuid, geom):
-        node = self.new_node(uuid, geom, None, 0)
+        node = self.new_data_node(uuid, geom)
         assert node.is_data_node
         node.dumps()
+        if uuid is not None:
+            self.ids[uuid] = node.id
         return node
 
     def create_with_children(self, children):
-        geom = bounding_box([c.geom for c in children])
-        uuid = str(generate_uuid())
-        child_ids = [c.uuid for c in children]
+        bounds = bounding_box([c.bounds for c in children])
+        child_ids = new_ids(c.id for c in children)
         level = children[0].level + 1
-        node = self.new_node(uuid, geom, child_ids, level)
+        node = self.new_node(self.allocate_ids(), bounds, child_ids, level)
         assert (not node.is_data_node)
         node.dumps()
         return node
 
     def insert(self, uuid, geom):
-        inserting_result = self.root.insert(self.create_data_node(uuid, geom))
+        node = self.create_data_node(uuid, geom)
+        inserting_result = self.root.insert(node)
         if type(inserting_result) is list:
             self.root = self.create_with_children(inserting_result)
+        self.bump_version()
+        return node
+
+    def bulk_load(self, data):
+        self.pack(self.new_data_nodes(data))
+
+    def pack(self, data_nodes):
+        # Sort-Tile-Recursive packing: every node is written exactly once, bottom-up.
+        if len(data_nodes) == 0:
+            return
+        placeholder = self.root if self.properties.ROOT_ID is not None else None
+        with tqdm(total=len(data_nodes), unit='item') as bar:
+            bar.set_description('Bulk loading R-tree')
+            for node in data_nodes:
+                node.dumps()
+                if node.uuid is not None:
+                    self.ids[node.uuid] = node.id
+                bar.update()
+        nodes = data_nodes
+        while len(nodes) > 1 or nodes[0].is_data_node:
+            nodes = [self.create_with_children(group) for group in self._str_groups(nodes)]
+        self.root = nodes[0]
+        if placeholder is not None and placeholder.children_num == 0:
+            placeholder.destruct()
+        self.bump_version()
+
+    def _str_groups(self, nodes):
+        capacity = self.properties.MAX_CHILDREN_NUM
+        page_num = ceil(len(nodes) / capacity)
+        slice_size = ceil(sqrt(page_num)) * capacity
+        centers = dict()
+        for node in nodes:
+            minx, miny, maxx, maxy = node.bounds
+            centers[node.id] = ((minx + maxx) / 2, (miny + maxy) / 2)
+        nodes = sorted(nodes, key=lambda n: centers[n.id][0])
+        groups = []
+        for i in range(0, len(nodes), slice_size):
+            vertical_slice = sorted(nodes[i:i + slice_size], key=lambda n: centers[n.id][1])
+            slice_groups = [vertical_slice[j:j + capacity] for j in range(0, len(vertical_slice), capacity)]
+            if len(slice_groups) > 1 and len(slice_groups[-1]) < self.properties.MIN_CHILDREN_NUM:
+                tail = slice_groups[-2] + slice_groups[-1]
+                half = len(tail) // 2
+                slice_groups[-2:] = [tail[:half], tail[half:]]
+            groups += slice_groups
+        return groups
 
     def delete(self, node):
+        if node.uuid is not None and node.uuid in self.ids:
+            del self.ids[node.uuid]
         nodes = self.root.find_leaf(node)
-        nodes[-1].remove_child(node.uuid)
+        nodes[-1].remove_child(node.id)
         node.destruct()
         self.condense_tree(nodes)
+        self.bump_version()
 
     def plot(self, ax):
         height = self.root.level
@@ -193,36 +656,45 @@ class RtreeIndex(object):
                 self.plot_subtree(ax, c, level)
 
     def intersects(self, geom: BaseGeometry):
+        query_bounds = to_bounds(geom)
+        prepared = prep(geom)
         nodes = {self.root}
         while len(nodes) > 0:
             e = nodes.pop()
+            if not intersects(query_bounds, e.bounds):
+                continue
             if e.is_data_node:
-                if geom.intersects(e.geom):
+                if prepared.intersects(e.geom):
                     yield e
             else:
-                if geom.intersects(e.geom):
+                if prepared.intersects(e.geom):
                     for child in e.children:
                         nodes.add(child)
 
     def contains(self, geom: BaseGeometry):
+        query_bounds = to_bounds(geom)
+        prepared = prep(geom)
         nodes = {self.root}
         while len(nodes) > 0:
             e = nodes.pop()
+            if not intersects(query_bounds, e.bounds):
+                continue
             if e.is_data_node:
-                if geom.contains(e.geom):
+                if prepared.contains(e.geom):
                     yield e
             else:
-                if geom.intersects(e.geom):
+                if prepared.intersects(e.geom):
                     for child in e.children:
                         nodes.add(child)
 
     def nearest(self, q, k=1):
+        id_q = None
         if type(q) == type(self.root):
-            point = q.geom
-            uuid_q = q.uuid
+            x, y = q.bounds[0], q.bounds[1]
+            if q.tree is self:
+                id_q = q.id
         elif type(q) == Point:
-            point = q
-            uuid_q = str(generate_uuid())
+            x, y = q.x, q.y
         h = MinHeap()
         knn = NSmallestHolder(k)
         h.push((0, self.root))
@@ -230,14 +702,16 @@ class RtreeIndex(object):
             e_min_dist, e = h.pop()
             if knn.is_full() and e_min_dist > knn.largest()[0]:
                 break
+            children = list(e.children)
+            if len(children) == 0:
+                continue
+            dists = mbr_min_dists(e.child_mbrs, x, y).tolist()
             if e.is_leaf_node:
-                for c in e.children:
-                    if c.uuid != uuid_q:
-                        c_min_dist = c.geom.distance(point)
+                for c, c_min_dist in zip(children, dists):
+                    if c.id != id_q:
                         knn.push((c_min_dist, c))
             else:
-                for c in e.children:
-                    c_min_dist = c.geom.distance(point)
+                for c, c_min_dist in zip(children, dists):
                     if len(knn) < k or c_min_dist < knn.first()[0]:
                         h.push((c_min_dist, c))
         for dist, e in knn:
@@ -250,25 +724,72 @@ class RtreeIndex(object):
             if not n.is_root and n.children_num < self.properties.MIN_CHILDREN_NUM:
                 for child in n.children:
                     eliminated_nodes.append(child)
-                nodes[-1].remove_child(n.uuid)
+                nodes[-1].remove_child(n.id)
                 n.destruct()
             else:
-                n.geom = bounding_box([c.geom for c in n.children])
+                n.bounds = bounding_box([c.bounds for c in n.children])
+                n.reset_child_mbrs()
                 n.dumps()
+        # the data nodes under eliminated subtrees are reinserted one by one, the subtrees themselves are dropped
+        data_nodes = []
         while len(eliminated_nodes) > 0:
-            self.root.insert(eliminated_nodes.pop())
+            n = eliminated_nodes.pop()
+            if n.is_data_node:
+                data_nodes.append(n)
+            else:
+                eliminated_nodes += list(n.children)
+                n.destruct()
+        root = self.root
+        while not root.is_leaf_node and root.children_num == 1:
+            child = next(iter(root.children))
+            self.root = child
+            root.destruct()
+            root = child
+        if not root.is_leaf_node and root.children_num == 0:
+            root.level = 1
+            root.bounds = None
+            root.dumps()
+        while len(data_nodes) > 0:
+            inserting_result = self.root.insert(data_nodes.pop())
+            if type(inserting_result) is list:
+                self.root = self.create_with_children(inserting_result)
 
 
 class RtreeNode(object):
-    def __init__(self, tree, uuid, geom, child_ids, level):
+    # id is the node's key in the index, uuid the external id a data node was inserted with
+    def __init__(self, tree, node_id, bounds, child_ids, level, uuid=None):
         self.tree = tree
+        self.id = node_id
         self.uuid = uuid
-        self.geom = geom
+        self.bounds = bounds
         self.child_ids = child_ids
         self.level = level
+        self._geom = None
+        self._geom_bounds = None
+        self._child_mbrs = None
+
+    @property
+    def geom(self):
+        # shapely geometries are only built on demand, all index arithmetic works on self.bounds
+        if self._geom is None or self._geom_bounds is not self.bounds:
+            self._geom = to_geom(self.bounds, self.is_data_node)
+            self._geom_bounds = self.bounds
+        return self._geom
+
+    @geom.setter
+    def geom(self, geom):
+        self.bounds = to_bounds(geom)
+        self._geom = geom
+        self._geom_bounds = self.bounds
+
+    @property
+    def coords(self):
+        if self.is_data_node and self.bounds is not None:
+            return self.bounds[:2]
+        return self.bounds
 
     def to_data(self):
-        return self.geom, self.child_ids, self.level
+        return self.coords, self.child_ids, self.level, self.uuid
 
     def __cmp__(self, other):
         return 0
@@ -288,20 +809,23 @@ class RtreeNode(object):
     def __eq__(self, other):
         if type(other) != type(self):
             return False
-        if other.uuid == self.uuid:
-            return True
+        return other.id == self.id and other.tree is self.tree
 
     def __hash__(self):
-        return hash(self.uuid)
+        return hash(self.id)
 
     def dumps(self):
-        self.tree.nodes[self.uuid] = self
+        self.tree.nodes[self.id] = self
 
     def destruct(self):
-        del self.tree.nodes[self.uuid]
+        del self.tree.nodes[self.id]
         del self.tree
+        del self.id
         del self.uuid
-        del self.geom
+        del self.bounds
+        del self._geom
+        del self._geom_bounds
+        del self._child_mbrs
         del self.child_ids
         del self.level
 
@@ -310,11 +834,23 @@ class RtreeNode(object):
         for child_id in self.child_ids:
             yield self.tree.nodes[child_id]
 
+    @property
+    def child_mbrs(self):
+        # the MBRs of the children as one (children, 4) array, kept until a child is added, removed or changes bounds
+        if self._child_mbrs is None:
+            self._child_mbrs = mbr_array(self.children)
+        return self._child_mbrs
+
+    def reset_child_mbrs(self):
+        self._child_mbrs = None
+
     def add_child(self, child):
-        self.child_ids.append(child.uuid)
+        self.child_ids.append(child.id)
+        self._child_mbrs = None
 
     def remove_child(self, child_id):
         self.child_ids.remove(child_id)
+        self._child_mbrs = None
 
     @property
     def children_num(self):
@@ -334,62 +870,55 @@ class RtreeNode(object):
 
     @property
     def is_root(self):
-        return self.tree.root is self
+        # nodes are compared by id, a node evicted from the NodePool may be reloaded as another object
+        return self.tree.properties.ROOT_ID == self.id
 
     def insert(self, node):
-        new_bounding_box = bounding_box([self.geom, node.geom])
+        new_bounding_box = union(self.bounds, node.bounds)
         if self.level == node.level + 1:
             self.add_child(node)
             if self.children_num > self.tree.properties.MAX_CHILDREN_NUM:
                 return self.split()
             else:
-                if new_bounding_box.area > self.geom.area:
-                    self.geom = new_bounding_box
+                if new_bounding_box != self.bounds:
+                    self.bounds = new_bounding_box
                 self.dumps()
                 return self
         else:
             inserting_child = self.find_inserting_child(node)
-            inserting_child_id = inserting_child.uuid
+            inserting_child_id = inserting_child.id
             inserting_result = inserting_child.insert(node)
             if type(inserting_result) is list:
                 self.remove_child(inserting_child_id)
                 for c in inserting_result:
                     self.add_child(c)
                 if self.children_num <= self.tree.properties.MAX_CHILDREN_NUM:
-                    if new_bounding_box.area > self.geom.area:
-                        self.geom = new_bounding_box
+                    if new_bounding_box != self.bounds:
+                        self.bounds = new_bounding_box
                     self.dumps()
                     return self
                 else:
                     return self.split()
 
             else:
-                if new_bounding_box.area > self.geom.area:
-                    self.geom = new_bounding_box
+                if self._child_mbrs is not None:
+                    self._child_mbrs[self.child_ids.index(inserting_child_id)] = inserting_result.bounds
+                if new_bounding_box != self.bounds:
+                    self.bounds = new_bounding_box
                     self.dumps()
                 return self
 
     def find_inserting_child(self, node):
-        min_enlargement = float('inf')
-        min_area = float('inf')
-        inserting_child = None
-        for e in self.children:
-            area = bounding_box([e.geom, node.geom]).area
-            enlargement = area - e.geom.area
-            if enlargement < min_enlargement:
-                inserting_child = e
-                min_enlargement = enlargement
-                min_area = area
-            elif enlargement == min_enlargement:
-                if area < min_area:
-                    inserting_child = e
-                    min_area = area
-        return inserting_child
+        children = list(self.children)
+        mbrs = self.child_mbrs
+        areas = mbr_union_areas(mbrs, node.bounds)
+        enlargements = areas - mbr_areas(mbrs)
+        return children[np.lexsort((areas, enlargements))[0]]
 
     def _quadratic_split(self):
         seeds, remain_entries = self._pick_seeds()
         groups = [[seeds[0]], [seeds[1]]]
-        group_bounding_boxes = [seeds[0].geom, seeds[1].geom]
+        group_bounding_boxes = [seeds[0].bounds, seeds[1].bounds]
         while len(remain_entries) > 0:
             if len(groups[0]) > self.tree.properties.MIN_CHILDREN_NUM:
                 groups[1] += remain_entries
@@ -398,8 +927,8 @@ class RtreeNode(object):
                 groups[0] += remain_entries
                 break
             e, bounding_boxes = self._pick_next(remain_entries, group_bounding_boxes)
-            areas = [bounding_boxes[0].area, bounding_boxes[1].area]
-            area_differences = [areas[0] - group_bounding_boxes[0].area, areas[1] - group_bounding_boxes[1].area]
+            areas = [area(bounding_boxes[0]), area(bounding_boxes[1])]
+            area_differences = [areas[0] - area(group_bounding_boxes[0]), areas[1] - area(group_bounding_boxes[1])]
             if area_differences[0] < area_differences[1]:
                 target_group_id = 0
             elif area_differences[0] > area_differences[1]:
@@ -422,27 +951,29 @@ class RtreeNode(object):
             self.destruct()
 
     def _pick_seeds(self):
-        seeds = max(itertools.combinations(self.children, 2),
-                    key=lambda x: bounding_box([x[0].geom, x[1].geom]).area - x[0].geom.area - x[1].geom.area)
+        children = list(self.children)
+        mbrs = self.child_mbrs
+        areas = mbr_areas(mbrs)
+        i, j = np.triu_indices(len(children), 1)
+        waste = ((np.maximum(mbrs[i, 2], mbrs[j, 2]) - np.minimum(mbrs[i, 0], mbrs[j, 0])) *
+                 (np.maximum(mbrs[i, 3], mbrs[j, 3]) - np.minimum(mbrs[i, 1], mbrs[j, 1])) - areas[i] - areas[j])
+        best = int(np.argmax(waste))
+        seeds = (children[i[best]], children[j[best]])
         remain_entries = []
-        for e in self.children:
+        for e in children:
             if e not in seeds:
                 remain_entries.append(e)
         return seeds, remain_entries
 
     @staticmethod
     def _pick_next(remain_entries, group_bounding_boxes):
-        difference = -1
-        for i in range(len(remain_entries)):
-            bbox1 = bounding_box([group_bounding_boxes[0], remain_entries[i].geom])
-            bbox2 = bounding_box([group_bounding_boxes[1], remain_entries[i].geom])
-            d1 = bbox1.area - group_bounding_boxes[0].area
-            d2 = bbox2.area - group_bounding_boxes[1].area
-            if abs(d1 - d2) > difference:
-                difference = abs(d1 - d2)
-                next_entry_id = i
-                next_bounding_boxes = [bbox1, bbox2]
+        mbrs = mbr_array(remain_entries)
+        d1 = mbr_union_areas(mbrs, group_bounding_boxes[0]) - area(group_bounding_boxes[0])
+        d2 = mbr_union_areas(mbrs, group_bounding_boxes[1]) - area(group_bounding_boxes[1])
+        next_entry_id = int(np.argmax(np.abs(d1 - d2)))
         next_entry = remain_entries.pop(next_entry_id)
+        next_bounding_boxes = [union(group_bounding_boxes[0], next_entry.bounds),
+                               union(group_bounding_boxes[1], next_entry.bounds)]
         return next_entry, next_bounding_boxes
 
     split = _quadratic_split
@@ -454,7 +985,7 @@ class RtreeNode(object):
                     return [self]
         else:
             for child in self.children:
-                if child.geom.intersects(node.geom):
+                if intersects(child.bounds, node.bounds):
                     result = child.find_leaf(node)
                     if result is not None:
                         return [self] + result
@@ -1,76 +1,592 @@
 # -*- coding:utf-8 -*-
 
-from scipy.spatial.qhull import Voronoi
+import os
+
+import numpy as np
+from scipy.spatial import Delaunay, QhullError, cKDTree
 from shapely.geometry import Point
 from tqdm import tqdm
 
 from common.data_structure import MinHeap
-from index.rtree import RtreeIndex, RtreeNode
+from common.persistence import FrozenArrays
+from index.rtree import NodeArray, RtreeIndex, RtreeNode, csr, distance, new_ids
 
 
 class VoRtreeIndex(RtreeIndex):
     def __init__(self, **kwargs):
+        kwargs.setdefault('bulk_load', True)
+        self._knn_table = None
+        self._knn_table_loaded = False
+        self._points = NodeArray()
+        # one-by-one construction links the whole diagram at the end instead of maintaining it on every insert
+        self.maintain_voronoi = False
         RtreeIndex.__init__(self, **kwargs)
+        self.maintain_voronoi = True
         data = kwargs.get('data', None)
         if data is not None:
-            with tqdm(total=len(data), unit='item') as bar:
-                bar.set_description('Building Voronoi diagram ')
-                voronoi = Voronoi([(geom.x, geom.y) for uuid, geom in data])
-                for ids in voronoi.ridge_points:
-                    nodes = [self.nodes[data[i][0]] for i in ids]
-                    nodes[0].add_neighbor(nodes[1])
-                    nodes[1].add_neighbor(nodes[0])
-                for uuid, geom in data:
-                    self.nodes[uuid].dumps()
-                    bar.update()
-                print('\033[38;2;116;20;12m'+f'VoR-tree({self.path}) is complete'+'\033[39m')
-
-    def new_node(self, uuid, geom, child_ids, level):
-        node = VoRtreeNode(self, uuid, geom, child_ids, None, level)
+            if not kwargs['bulk_load']:
+                nodes = [self.lookup(uuid) for uuid, geom in data]
+                self.link_neighbors(nodes)
+                for node in nodes:
+                    node.dumps()
+            print('\033[38;2;116;20;12m'+f'VoR-tree({self.path}) is complete'+'\033[39m')
+
+    def bulk_load(self, data):
+        nodes = self.new_data_nodes(data)
+        self.link_neighbors(nodes)
+        self.pack(nodes)
+
+    @staticmethod
+    def link_neighbors(nodes):
+        if len(nodes) < 3:
+            # too few sites for a triangulation, they are all neighbours of each other
+            for node in nodes:
+                node.neighbor_ids = new_ids([other.id for other in nodes if other.id != node.id])
+            return
+        with tqdm(total=len(nodes), unit='item') as bar:
+            bar.set_description('Building Voronoi diagram ')
+            # Voronoi neighbours are Delaunay neighbours, the triangulation also links cocircular sites whose common
+            # Voronoi edge has zero length, so that the graph stays a triangulation under incremental updates
+            indptr, indices = Delaunay([node.coords for node in nodes]).vertex_neighbor_vertices
+            neighbor_ids = np.array([node.id for node in nodes], dtype=np.int64)[indices]
+            for i, node in enumerate(nodes):
+                node.neighbor_ids = new_ids(neighbor_ids[indptr[i]:indptr[i + 1]].tolist())
+            bar.update(len(nodes))
+
+    def insert(self, uuid, geom):
+        # the Voronoi diagram is updated around the new site only, by Bowyer-Watson insertion into the Delaunay graph
+        cavity = self.insertion_cavity(geom.x, geom.y) if self.maintain_voronoi else None
+        node = RtreeIndex.insert(self, uuid, geom)
+        if not self.maintain_voronoi:
+            return node
+        if cavity is None:
+            self.relink()
+            return node
+        sites, removed_edges = cavity
+        changed = dict()
+        for u, v in removed_edges:
+            for a, b in ((u, v), (v, u)):
+                changed.setdefault(a, self.nodes[a]).neighbor_ids.remove(b)
+        for site in sites:
+            changed.setdefault(site, self.nodes[site]).add_neighbor(node)
+        node.neighbor_ids = new_ids(sorted(sites))
+        for changed_node in changed.values():
+            changed_node.dumps()
+        node.dumps()
+        return node
+
+    def delete(self, node):
+        # the hole left by the site is filled with the Delaunay triangles of its neighbours that lie inside it
+        if not self.maintain_voronoi:
+            RtreeIndex.delete(self, node)
+            return
+        node_id = node.id
+        neighbor_ids = list(node.neighbor_ids) if node.neighbor_ids is not None else []
+        new_edges = self.deletion_edges(node) if len(neighbor_ids) >= 3 else None
+        RtreeIndex.delete(self, node)
+        if new_edges is None:
+            self.relink()
+            return
+        changed = {neighbor_id: self.nodes[neighbor_id] for neighbor_id in neighbor_ids}
+        for neighbor in changed.values():
+            neighbor.neighbor_ids.remove(node_id)
+        for u, v in new_edges:
+            if v not in changed[u].neighbor_ids:
+                changed[u].neighbor_ids.append(v)
+                changed[v].neighbor_ids.append(u)
+        for neighbor in changed.values():
+            neighbor.dumps()
+
+    def data_nodes(self):
+        nodes = [self.nodes[i] for i in range(self.properties.NEXT_ID) if i in self.nodes]
+        return [node for node in nodes if node.is_data_node]
+
+    def relink(self):
+        # rebuilds the whole diagram, for indices too small or too degenerate to be updated locally
+        nodes = self.data_nodes()
+        self.link_neighbors(nodes)
+        for node in nodes:
+            node.dumps()
+
+    def ccw_neighbor_ids(self, site, stars):
+        # neighbours of a site sorted counterclockwise around it, memoized in stars for one update
+        if site not in stars:
+            x, y = self.point(site)
+            neighbor_ids = list(self.neighbor_ids(site))
+            angles = [np.arctan2(ny - y, nx - x) for nx, ny in map(self.point, neighbor_ids)]
+            stars[site] = [neighbor_id for angle, neighbor_id in sorted(zip(angles, neighbor_ids))]
+        return stars[site]
+
+    def triangle(self, a, b, c, stars):
+        # the triangle (a, b, c) in counterclockwise order if a, b and c form one, with its smallest id first
+        if b == c or c not in self.ccw_neighbor_ids(b, stars):
+            return None
+        if orientation(self.point(a), self.point(b), self.point(c)) <= 0:
+            return None
+        i = min(range(3), key=lambda j: (a, b, c)[j])
+        return ('t',) + ((a, b, c) * 2)[i:i + 3]
+
+    def right_of(self, a, b, stars):
+        # the triangle on the right of the directed edge a -> b, or the ghost of the hull edge a -> b
+        star = self.ccw_neighbor_ids(a, stars)
+        z = star[star.index(b) - 1]
+        return self.triangle(a, z, b, stars) or ('g', a, b)
+
+    def left_of(self, a, b, stars):
+        star = self.ccw_neighbor_ids(a, stars)
+        w = star[(star.index(b) + 1) % len(star)]
+        return self.triangle(a, b, w, stars)
+
+    def insertion_cavity(self, x, y):
+        # Triangles whose circumcircle strictly contains (x, y), and hull edges that see it (ghosts), found by walking
+        # triangle adjacency from the nearest site. Returns the sites the new one links to and the Delaunay edges inside
+        # the cavity, or None when the diagram is too small or degenerate around (x, y).
+        nn = list(RtreeIndex.nearest(self, Point(x, y), 1)) if self.properties.ROOT_ID is not None else []
+        if len(nn) == 0 or self.neighbor_ids(nn[0][0].id) is None or len(self.neighbor_ids(nn[0][0].id)) < 2:
+            return None
+        p = (x, y)
+        stars = dict()
+        site = nn[0][0].id
+        star = self.ccw_neighbor_ids(site, stars)
+        seeds = []
+        for b, c in zip(star, star[1:] + star[:1]):
+            t = self.triangle(site, b, c, stars)
+            seeds += [t] if t is not None else [('g', b, site), ('g', site, c)]
+        cavity = set()
+        frontier = [e for e in seeds if self.in_conflict(e, p)]
+        while len(frontier) > 0:
+            e = frontier.pop()
+            if e in cavity:
+                continue
+            cavity.add(e)
+            if e[0] == 't':
+                a, b, c = e[1:]
+                adjacent = [self.right_of(a, b, stars), self.right_of(b, c, stars), self.right_of(c, a, stars)]
+            else:
+                a, b = e[1:]
+                star_a = self.ccw_neighbor_ids(a, stars)
+                star_b = self.ccw_neighbor_ids(b, stars)
+                adjacent = [self.left_of(a, b, stars), ('g', star_a[star_a.index(b) - 1], a),
+                            ('g', b, star_b[(star_b.index(a) + 1) % len(star_b)])]
+            frontier += [f for f in adjacent if f is not None and f not in cavity and self.in_conflict(f, p)]
+        if len(cavity) == 0:
+            return None
+        sites = set()
+        edge_counts = dict()
+        for e in cavity:
+            sites.update(e[1:])
+            edges = [e[1:3], e[2:4], (e[3], e[1])] if e[0] == 't' else [e[1:3]]
+            for u, v in edges:
+                edge = (min(u, v), max(u, v))
+                edge_counts[edge] = edge_counts.get(edge, 0) + 1
+        return sites, [edge for edge, count in edge_counts.items() if count > 1]
+
+    def in_conflict(self, e, p):
+        if e[0] == 't':
+            return in_circle(self.point(e[1]), self.point(e[2]), self.point(e[3]), p) > 0
+        a, b = self.point(e[1]), self.point(e[2])
+        side = orientation(a, b, p)
+        if side != 0:
+            return side < 0
+        # on the line of the hull edge, the ghost is only in conflict between its ends
+        return (p[0] - a[0]) * (p[0] - b[0]) + (p[1] - a[1]) * (p[1] - b[1]) < 0
+
+    def deletion_edges(self, node):
+        # The Delaunay triangles of the neighbours whose centroid lies in one of the triangles around the deleted site.
+        # Returns the edges between neighbours they add, or None when the neighbours are degenerate.
+        stars = dict()
+        star = self.ccw_neighbor_ids(node.id, stars)
+        p = node.coords
+        fan = [(self.point(b), self.point(c)) for b, c in zip(star, star[1:] + star[:1])
+               if orientation(p, self.point(b), self.point(c)) > 0]
+        coords = np.array([self.point(neighbor_id) for neighbor_id in star], dtype=float)
+        try:
+            simplices = Delaunay(coords).simplices
+        except QhullError:
+            return None
+        edges = set()
+        for simplex in simplices.tolist():
+            centroid = tuple(coords[simplex].mean(axis=0))
+            if any(in_triangle(p, b, c, centroid) for b, c in fan):
+                for i, j in ((0, 1), (1, 2), (2, 0)):
+                    u, v = star[simplex[i]], star[simplex[j]]
+                    edges.add((min(u, v), max(u, v)))
+        return edges
+
+    def close(self):
+        if self._knn_table is not None:
+            self._knn_table.close()
+            self._knn_table = None
+        RtreeIndex.close(self)
+
+    def drop_file(self):
+        RtreeIndex.drop_file(self)
+        if self.knn_path is not None and os.path.isfile(self.knn_path):
+            os.remove(self.knn_path)
+
+    @property
+    def knn_path(self):
+        return None if self.path is None else self.path + '-knn'
+
+    @property
+    def knn_table(self):
+        # a table computed for another version of the index is stale and ignored, the file stays until the next
+        # precompute_knn_radii() overwrites it
+        if not self._knn_table_loaded:
+            self._knn_table_loaded = True
+            if self.knn_path is not None and FrozenArrays.is_frozen(self.knn_path):
+                self._knn_table = KnnRadiusTable.load(self.knn_path)
+        if self._knn_table is not None and self._knn_table.version != self.version:
+            self.drop_knn_radii()
+        return self._knn_table
+
+    def precompute_knn_radii(self, ks, chunk_size=4096):
+        # Stores the k-th nearest neighbour distance of every data node for each k in ks, next to the database when
+        # the index has a path and can be written, only in memory otherwise. kNN radius lookups consult it until the
+        # index is modified.
+        ks = sorted(set(ks))
+        if len(ks) == 0 or not all(isinstance(k, int) and k > 0 for k in ks):
+            raise ValueError(f'ks must be positive integers, got {ks}')
+        size = self.properties.NEXT_ID
+        nodes = self.data_nodes()
+        radii = np.full((size, len(ks)), np.nan)
+        if len(nodes) > 1:
+            ids = np.array([node.id for node in nodes], dtype=np.int64)
+            coords = np.array([node.coords for node in nodes], dtype=float)
+            # with fewer than k other sites the k-th radius is the farthest one, like nearest() returns
+            k_max = min(ks[-1], len(nodes) - 1)
+            columns = np.minimum(ks, k_max)
+            tree = cKDTree(coords)
+            with tqdm(total=len(nodes), unit='item') as bar:
+                bar.set_description('Precomputing kNN radii')
+                for i in range(0, len(nodes), chunk_size):
+                    # the first column is the site itself, or a duplicate at distance 0
+                    dists, neighbors = tree.query(coords[i:i + chunk_size], k_max + 1)
+                    neighbors = neighbors.reshape(len(coords[i:i + chunk_size]), -1)[:, columns]
+                    # recomputed with the GEOS formula so that they compare exactly with distances to q
+                    dx = coords[neighbors, 0] - coords[i:i + chunk_size, 0][:, None]
+                    dy = coords[neighbors, 1] - coords[i:i + chunk_size, 1][:, None]
+                    radii[ids[i:i + chunk_size]] = np.sqrt(dx * dx + dy * dy)
+                    bar.update(len(neighbors))
+        self.drop_knn_radii()
+        self._knn_table = KnnRadiusTable(ks, radii, self.version)
+        if self.knn_path is not None and not self.readonly:
+            self._knn_table.write(self.knn_path)
+            self._knn_table = KnnRadiusTable.load(self.knn_path)
+
+    def knn_sets(self, ps, k, sites=None, chunk_size=4096):
+        # For each of ps, the ids of the sites within its kNN radius, ties at the radius included and p itself
+        # excluded. sites may pass self.data_nodes() when the caller already has them.
+        if sites is None:
+            sites = self.data_nodes()
+        if len(sites) == 0:
+            for p in ps:
+                yield []
+            return
+        ids = np.array([site.id for site in sites], dtype=np.int64)
+        coords = np.array([site.coords for site in sites], dtype=float)
+        tree = cKDTree(coords)
+        # p itself and one site past the k-th, which tells whether ties may reach beyond the columns queried
+        m = min(k + 2, len(sites))
+        for i in range(0, len(ps), chunk_size):
+            chunk = ps[i:i + chunk_size]
+            own = np.array([p.id if p.tree is self else -1 for p in chunk], dtype=np.int64)
+            xy = np.array([p.coords for p in chunk], dtype=float)
+            dists, columns = tree.query(xy, m)
+            columns = columns.reshape(len(chunk), -1)
+            site_ids = ids[columns]
+            # recomputed with the GEOS formula so that they compare exactly with the kNN radii of the queries
+            dx = coords[columns, 0] - xy[:, 0][:, None]
+            dy = coords[columns, 1] - xy[:, 1][:, None]
+            exact = np.sqrt(dx * dx + dy * dy)
+            exact[site_ids == own[:, None]] = np.inf
+            ordered = np.sort(exact, axis=1)
+            for j, p in enumerate(chunk):
+                others = int(np.isfinite(ordered[j]).sum())
+                if others == 0:
+                    yield []
+                    continue
+                # with fewer than k other sites the k-th radius is the farthest one, like nearest() returns
+                r = ordered[j, min(k, others) - 1]
+                if m < len(sites) and ordered[j, others - 1] <= r * (1 + 1e-9):
+                    # every queried site ties with the k-th, the rest of the ties are fetched by radius
+                    ball = np.array(tree.query_ball_point(xy[j], r * (1 + 1e-9) + 1e-12), dtype=np.int64)
+                    ball_dx = coords[ball, 0] - xy[j, 0]
+                    ball_dy = coords[ball, 1] - xy[j, 1]
+                    within = ball[(np.sqrt(ball_dx * ball_dx + ball_dy * ball_dy) <= r) & (ids[ball] != own[j])]
+                    yield ids[within].tolist()
+                else:
+                    yield site_ids[j][exact[j] <= r].tolist()
+
+    def drop_knn_radii(self):
+        # forgets the table in memory only, a file on disk is told stale by its version
+        self._knn_table_loaded = True
+        if self._knn_table is not None:
+            self._knn_table.close()
+            self._knn_table = None
+
+    def precomputed_knn_radius(self, p, k):
+        if self.knn_table is None or not isinstance(p, RtreeNode) or p.tree is not self:
+            return None
+        return self.knn_table.radius(p.id, k)
+
+    # Voronoi expansions read sites by id without building their nodes. Coordinates are kept by node id once read, a
+    # site never moves and ids are never reused, and come from the arrays of a frozen index. Neighbour lists come from
+    # the CSR arrays of a frozen index, and from the nodes of an index that can change them.
+    def neighbor_ids(self, node_id):
+        if self.frozen:
+            offsets = self.database['neighbor_offsets']
+            return self.database['neighbor_ids'][offsets[node_id]:offsets[node_id + 1]].tolist()
+        return self.nodes[node_id].neighbor_ids
+
+    def point(self, node_id):
+        try:
+            point = self._points[node_id]
+        except IndexError:
+            point = None
+        if point is None:
+            if self.frozen:
+                point = tuple(self.database['bounds'][node_id, :2].tolist())
+            else:
+                bounds = self.nodes[node_id].bounds
+                point = bounds[0], bounds[1]
+            self._points[node_id] = point
+        return point
+
+    def frozen_arrays(self, nodes):
+        arrays = RtreeIndex.frozen_arrays(self, nodes)
+        arrays['neighbor_offsets'], arrays['neighbor_ids'] = csr([None if n is None else n.neighbor_ids
+                                                                 for n in nodes])
+        return arrays
+
+    def new_node(self, node_id, bounds, child_ids, level, uuid=None):
+        node = VoRtreeNode(self, node_id, bounds, child_ids, None, level, uuid)
         return node
 
-    def loads(self, uuid, data):
-        node = self.new_node(uuid, data[0], data[1], data[2])
-        node.neighbor_ids = data[3]
+    def loads(self, node_id, data):
+        node = self.new_node(node_id, self.loads_bounds(data[0]), data[1], data[2], data[3])
+        node.neighbor_ids = data[4]
         return node
 
     def nearest(self, q, k=1):
+        # the expansion works on node ids, nodes are only fetched for the coordinates and the results
         h = MinHeap()
         visited = set()
         if type(q) == type(self.root):
-            point = q.geom
+            x, y = q.coords
         elif type(q) == Point:
-            point = q
-        if type(q) == type(self.root) and q.uuid in self.nodes:
-            visited.add(q)
-            for neighbor in q.neighbors:
-                visited.add(neighbor)
-                h.push((point.distance(neighbor.geom), neighbor))
+            x, y = q.x, q.y
+        if type(q) == type(self.root) and q.tree is self:
+            visited.add(q.id)
+            for neighbor_id in q.neighbor_ids:
+                visited.add(neighbor_id)
+                h.push((distance(x, y, *self.point(neighbor_id)), neighbor_id))
         else:
-            nn, dist_nn = list(RtreeIndex.nearest(self, point, 1))[0]
-            h.push((dist_nn, nn))
-            visited.add(nn)
+            nn, dist_nn = list(RtreeIndex.nearest(self, Point(x, y), 1))[0]
+            h.push((dist_nn, nn.id))
+            visited.add(nn.id)
         for i in range(k):
             if len(h) > 0:
                 dist_p, p = h.pop()
-                yield p, dist_p
+                yield self.nodes[p], dist_p
                 if i == k - 1:
                     break
-                for neighbor in p.neighbors:
-                    if neighbor not in visited:
-                        visited.add(neighbor)
-                        h.push((point.distance(neighbor.geom), neighbor))
+                for neighbor_id in self.neighbor_ids(p):
+                    if neighbor_id not in visited:
+                        visited.add(neighbor_id)
+                        h.push((distance(x, y, *self.point(neighbor_id)), neighbor_id))
             else:
                 break
 
+    def count_closer_than(self, p, dist, limit=None):
+        # number of sites strictly closer to p than dist, not counting p itself, sites are visited in order of distance
+        # so the expansion never leaves the disk and stops as soon as limit sites are found
+        if limit is not None and limit <= 0:
+            return 0
+        h = MinHeap()
+        visited = set()
+        if type(p) == type(self.root):
+            x, y = p.coords
+        elif type(p) == Point:
+            x, y = p.x, p.y
+        if type(p) == type(self.root) and p.tree is self:
+            visited.add(p.id)
+            for neighbor_id in p.neighbor_ids:
+                visited.add(neighbor_id)
+                h.push((distance(x, y, *self.point(neighbor_id)), neighbor_id))
+        else:
+            nn, dist_nn = list(RtreeIndex.nearest(self, Point(x, y), 1))[0]
+            h.push((dist_nn, nn.id))
+            visited.add(nn.id)
+        count = 0
+        while len(h) > 0:
+            dist_s, s = h.pop()
+            if dist_s >= dist:
+                break
+            count += 1
+            if limit is not None and count >= limit:
+                break
+            for neighbor_id in self.neighbor_ids(s):
+                if neighbor_id not in visited:
+                    visited.add(neighbor_id)
+                    h.push((distance(x, y, *self.point(neighbor_id)), neighbor_id))
+        return count
+
+    def knn_radii(self, qs, k, pool=None):
+        radii = [self.precomputed_knn_radius(q, k) for q in qs]
+        missing = [i for i, r in enumerate(radii) if r is None]
+        if len(missing) > 0:
+            if pool is None:
+                pool = SitePool(self, Point(np.mean([qs[i].coords for i in missing], axis=0)))
+            for i, r in zip(missing, pool.knn_radii([qs[i] for i in missing], k)):
+                radii[i] = r
+        return radii
+
+
+def orientation(a, b, c):
+    # positive when a, b, c turn counterclockwise
+    return (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+
+
+def in_circle(a, b, c, d):
+    # positive when d lies inside the circumcircle of the counterclockwise triangle a, b, c
+    ax, ay = a[0] - d[0], a[1] - d[1]
+    bx, by = b[0] - d[0], b[1] - d[1]
+    cx, cy = c[0] - d[0], c[1] - d[1]
+    return ((ax * ax + ay * ay) * (bx * cy - cx * by) - (bx * bx + by * by) * (ax * cy - cx * ay) +
+            (cx * cx + cy * cy) * (ax * by - bx * ay))
+
+
+def in_triangle(a, b, c, p):
+    sides = (orientation(a, b, p), orientation(b, c, p), orientation(c, a, p))
+    return min(sides) >= 0 or max(sides) <= 0
+
+
+class KnnRadiusTable(object):
+    # k-th nearest neighbour distances by node id (rows) and k (columns), NaN for nodes that are not data nodes, valid
+    # for the version of the index they were computed at
+    def __init__(self, ks, radii, version, arrays=None):
+        self.ks = list(ks)
+        self.columns = {k: j for j, k in enumerate(self.ks)}
+        self.radii = radii
+        self.version = version
+        self.arrays = arrays
+
+    @staticmethod
+    def load(path):
+        # tables written before they carried a version are never current
+        arrays = FrozenArrays(path)
+        return KnnRadiusTable(arrays.properties['ks'], arrays['radii'], arrays.properties.get('VERSION'), arrays)
+
+    def write(self, path):
+        FrozenArrays.write(path, {'ks': self.ks, 'VERSION': self.version}, {'radii': self.radii})
+
+    def radius(self, node_id, k):
+        if k not in self.columns or node_id >= len(self.radii):
+            return None
+        r = float(self.radii[node_id, self.columns[k]])
+        return None if r != r else r
+
+    def close(self):
+        self.radii = None
+        if self.arrays is not None:
+            self.arrays.close()
+
+
+class SitePool(object):
+    # Sites of a VoR-tree collected in order of distance from a center, every site closer than self.radius is
+    # in the pool. The kNN radii of nodes around the center are read off one distance matrix against the pool,
+    # so the queries of a batch, and successive batches, share a single Voronoi expansion.
+    def __init__(self, index, center):
+        self.index = index
+        if isinstance(center, RtreeNode):
+            self.x, self.y = center.coords
+        else:
+            self.x, self.y = center.x, center.y
+        self.positions = dict()
+        self._coords = np.empty((0, 2))
+        self._new_coords = []
+        self.heap = MinHeap()
+        self.visited = set()
+        if isinstance(center, RtreeNode) and center.tree is index:
+            seed = center
+        else:
+            seed, dist_seed = list(RtreeIndex.nearest(index, Point(self.x, self.y), 1))[0]
+        self._push(seed.id)
+        self.radius = 0.0
+
+    def _push(self, node_id):
+        self.visited.add(node_id)
+        x, y = self.index.point(node_id)
+        self.heap.push((distance(self.x, self.y, x, y), node_id, (x, y)))
+
+    def grow(self, radius=None, count=None):
+        while len(self.heap) > 0:
+            if not ((radius is not None and self.heap.first()[0] <= radius) or
+                    (count is not None and len(self.positions) < count)):
+                break
+            dist_p, p, coords = self.heap.pop()
+            self.positions[p] = len(self.positions)
+            self._new_coords.append(coords)
+            for neighbor_id in self.index.neighbor_ids(p):
+                if neighbor_id not in self.visited:
+                    self._push(neighbor_id)
+        self.radius = self.heap.first()[0] if len(self.heap) > 0 else float('inf')
+
+    @property
+    def is_complete(self):
+        return len(self.heap) == 0
+
+    @property
+    def coords(self):
+        if len(self._new_coords) > 0:
+            self._coords = np.concatenate([self._coords, np.asarray(self._new_coords, dtype=float)])
+            self._new_coords = []
+        return self._coords
+
+    def knn_radii(self, qs, k):
+        if k == 0:
+            return [0 for q in qs]
+        if len(qs) == 0:
+            return []
+        coords = np.array([q.coords for q in qs], dtype=float)
+        offsets = np.sqrt((coords[:, 0] - self.x) ** 2 + (coords[:, 1] - self.y) ** 2)
+        self.grow(count=k + 1)
+        while True:
+            kth = self._kth_distances(qs, coords, k)
+            # sites within kth of q are within kth + offset of the center, so they are all in the pool
+            needed = (kth + offsets) * (1 + 1e-9)
+            if self.is_complete or (needed < self.radius).all():
+                return kth.tolist()
+            self.grow(radius=float(needed.max()))
+
+    def _kth_distances(self, qs, coords, k):
+        sites = self.coords
+        kth = np.empty(len(qs))
+        step = max(1, 4000000 // max(1, len(sites)))
+        for i in range(0, len(qs), step):
+            dx = coords[i:i + step, 0][:, None] - sites[:, 0][None, :]
+            dy = coords[i:i + step, 1][:, None] - sites[:, 1][None, :]
+            dists = np.sqrt(dx * dx + dy * dy)
+            for j, q in enumerate(qs[i:i + step]):
+                if q.tree is self.index and q.id in self.positions:
+                    dists[j, self.positions[q.id]] = float('inf')
+            part = np.partition(dists, min(k, len(sites)) - 1, axis=1)[:, min(k, len(sites)) - 1]
+            if self.is_complete:
+                # fewer than k other sites in the whole index, take the farthest one like nearest() does
+                finite = np.where(np.isinf(dists), -np.inf, dists).max(axis=1)
+                part = np.where(np.isinf(part), finite, part)
+            kth[i:i + step] = part
+        return kth
+
 
 class VoRtreeNode(RtreeNode):
-    def __init__(self, tree, uuid, geom, child_ids, neighbor_ids, level):
-        RtreeNode.__init__(self, tree, uuid, geom, child_ids, level)
+    def __init__(self, tree, node_id, bounds, child_ids, neighbor_ids, level, uuid=None):
+        RtreeNode.__init__(self, tree, node_id, bounds, child_ids, level, uuid)
         self.neighbor_ids = neighbor_ids
 
     def to_data(self):
-        return self.geom, self.child_ids, self.level, self.neighbor_ids
+        return self.coords, self.child_ids, self.level, self.uuid, self.neighbor_ids
 
     def destruct(self):
         RtreeNode.destruct(self)
@@ -83,5 +599,5 @@ class VoRtreeNode(RtreeNode):
 
     def add_neighbor(self, neighbor):
         if self.neighbor_ids is None:
-            self.neighbor_ids = []
-        self.neighbor_ids.append(neighbor.uuid)
+            self.neighbor_ids = new_ids()
+        self.neighbor_ids.append(neighbor.id)
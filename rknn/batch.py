@@ -0,0 +1,39 @@
+from multiprocessing import Pool
+
+from index.vortree import VoRtreeIndex
+from rknn import csd, slice, vr
+
+algorithms = {'csd': csd, 'slice': slice, 'vr': vr}
+
+# indices opened once per worker process by open_indices and reused by every query the worker answers
+facility_index = None
+user_index = None
+
+
+def open_indices(facility_path, user_path):
+    global facility_index, user_index
+    facility_index = VoRtreeIndex(path=facility_path, readonly=True)
+    if user_path is not None:
+        user_index = VoRtreeIndex(path=user_path, readonly=True)
+
+
+def query(args):
+    q_id, algorithm, k, kwargs = args
+    q = facility_index.lookup(q_id)
+    if user_index is None:
+        result = algorithms[algorithm].MonoRkNN(q, k, facility_index, **kwargs)
+    else:
+        result = algorithms[algorithm].BiRkNN(q, k, facility_index, user_index, **kwargs)
+    return q_id, [e.uuid for e in result]
+
+
+def BatchRkNN(q_ids, algorithm, k, facility_path, user_path=None, processes=None, chunksize=8, **kwargs):
+    # Answers many RkNN queries on a process pool and streams (query id, result ids) pairs in completion order.
+    # Mono-RkNN queries are run against facility_path, Bi-RkNN queries when user_path is given.
+    algorithm = algorithm.lower()
+    if algorithm not in algorithms:
+        raise ValueError(f'unknown RkNN algorithm {algorithm}, expected one of {sorted(algorithms)}')
+    tasks = ((q_id, algorithm, k, kwargs) for q_id in q_ids)
+    with Pool(processes, initializer=open_indices, initargs=(facility_path, user_path)) as pool:
+        for q_id, result_ids in pool.imap_unordered(query, tasks, chunksize):
+            yield q_id, result_ids
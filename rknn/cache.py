@@ -0,0 +1,80 @@
+from collections import OrderedDict
+
+from rknn import csd, slice, vr
+
+algorithms = {'csd': csd, 'slice': slice, 'vr': vr}
+
+# options that change how a result is computed but not the result, queries with any other option are not cached
+shared_kwargs = {'batch', 'partition_num', 'dist_cal'}
+
+
+class RkNNCache(object):
+    # Memoizes the result ids of RkNN queries against one facility index, and one user index for Bi-RkNN, in LRU
+    # order. Keys carry the versions of the indices, which every insert and delete bumps, so results computed before
+    # a change are never returned and are dropped on the next lookup.
+    def __init__(self, facility_index, user_index=None, capacity=1024):
+        if capacity <= 0:
+            raise ValueError(f'capacity must be positive, got {capacity}')
+        self.facility_index = facility_index
+        self.user_index = user_index
+        self.capacity = capacity
+        self.results = OrderedDict()
+        self.versions = self.current_versions()
+        self.hits = 0
+        self.misses = 0
+        self.bypasses = 0
+
+    def current_versions(self):
+        return self.facility_index.version, None if self.user_index is None else self.user_index.version
+
+    def clear(self):
+        self.results.clear()
+
+    def query(self, q, k, algorithm, mode, **kwargs):
+        algorithm = algorithm.lower()
+        if algorithm not in algorithms:
+            raise ValueError(f'unknown RkNN algorithm {algorithm}, expected one of {sorted(algorithms)}')
+        if mode == 'bi':
+            if self.user_index is None:
+                raise ValueError('Bi-RkNN queries need a cache created with a user index')
+            result_index = self.user_index
+        else:
+            result_index = self.facility_index
+        if q.tree is not self.facility_index:
+            # only queries by nodes of the facility index have a stable id to cache under
+            return self.compute(q, k, algorithm, mode, **kwargs)
+        if not shared_kwargs.issuperset(kwargs):
+            # e.g. an approximation, a shared kNN radius dict or a query control, whose results may differ
+            self.bypasses += 1
+            return self.compute(q, k, algorithm, mode, **kwargs)
+        versions = self.current_versions()
+        if versions != self.versions:
+            self.clear()
+            self.versions = versions
+        key = (versions, q.id, k, algorithm, mode)
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+        else:
+            self.misses += 1
+            self.results[key] = tuple(e.id for e in self.compute(q, k, algorithm, mode, **kwargs))
+            if len(self.results) > self.capacity:
+                self.results.popitem(last=False)
+        return [result_index.nodes[node_id] for node_id in self.results[key]]
+
+    def compute(self, q, k, algorithm, mode, **kwargs):
+        if mode == 'bi':
+            return list(algorithms[algorithm].BiRkNN(q, k, self.facility_index, self.user_index, **kwargs))
+        return list(algorithms[algorithm].MonoRkNN(q, k, self.facility_index, **kwargs))
+
+    def MonoRkNN(self, q, k, algorithm='csd', **kwargs):
+        return iter(self.query(q, k, algorithm, 'mono', **kwargs))
+
+    def BiRkNN(self, q, k, algorithm='csd', **kwargs):
+        return iter(self.query(q, k, algorithm, 'bi', **kwargs))
+
+    @property
+    def statistics(self):
+        requests = self.hits + self.misses
+        return {'capacity': self.capacity, 'size': len(self.results), 'hits': self.hits, 'misses': self.misses,
+                'bypasses': self.bypasses, 'hit_rate': self.hits / requests if requests > 0 else 0.0}
@@ -0,0 +1,44 @@
+import time
+
+
+class QueryStopped(Exception):
+    pass
+
+
+class Cancellation(object):
+    # shared between a running query and whoever may call it off, the query stops at its next step after cancel()
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class QueryControl(object):
+    # Progress of one RkNN query and the limits it runs under. The algorithms call visit() for every candidate or
+    # tree entry they take up, load() with the number of nodes they fetch to extend their search and check() in
+    # loops over work already counted. visit() and check() raise QueryStopped once the deadline (a time.monotonic()
+    # value) has passed or the query has been cancelled.
+    def __init__(self, deadline=None, cancellation=None):
+        self.deadline = deadline
+        self.cancellation = cancellation
+        self.visited = 0
+        self.loaded = 0
+        self.stop_reason = None
+
+    def visit(self):
+        self.visited += 1
+        self.check()
+
+    def check(self):
+        if self.cancellation is not None and self.cancellation.cancelled:
+            self.stop('cancelled')
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.stop('deadline')
+
+    def load(self, count=1):
+        self.loaded += count
+
+    def stop(self, reason):
+        self.stop_reason = reason
+        raise QueryStopped(reason)
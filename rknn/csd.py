@@ -1,45 +1,277 @@
+import random
+import time
+from math import ceil, erf, sqrt
+
+from index.rtree import distance
+from index.vortree import SitePool
+from rknn.control import QueryControl
+
+
 class DistanceCalculator:
-    def __init__(self):
+    # Distances between the points met by one query, computed from their coordinates. Pairs of points of the same
+    # index are cached once per unordered pair of node ids, and the cache is emptied whenever it reaches capacity.
+    def __init__(self, capacity=65536):
         self.cache = dict()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
 
     def dist(self, p1, p2):
-        if (p1, p2) not in self.cache:
-            d = p1.geom.distance(p2.geom)
-            self.cache[(p1, p2)] = d
-            self.cache[(p2, p1)] = d
+        if p1.tree is not p2.tree:
+            self.misses += 1
+            return distance(p1.bounds[0], p1.bounds[1], p2.bounds[0], p2.bounds[1])
+        key = (p1.id, p2.id) if p1.id < p2.id else (p2.id, p1.id)
+        d = self.cache.get(key)
+        if d is not None:
+            self.hits += 1
             return d
+        self.misses += 1
+        if len(self.cache) >= self.capacity:
+            self.cache.clear()
+        d = distance(p1.bounds[0], p1.bounds[1], p2.bounds[0], p2.bounds[1])
+        self.cache[key] = d
+        return d
+
+    @property
+    def statistics(self):
+        requests = self.hits + self.misses
+        return {'capacity': self.capacity, 'size': len(self.cache), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests > 0 else 0.0}
+
+
+class Approximation:
+    # Settings and outcome of an approximate RkNN query, passed to MonoRkNN/BiRkNN and read back once the query is
+    # consumed. A point whose kNN radius is unknown is decided by the radii of its Voronoi neighbours when they bound
+    # its own radius on one side of its distance to q, and otherwise against their mean radius. A sample_rate share
+    # of those estimates, and the points without a known neighbour, get their exact radius. Negative points are
+    # expanded at most boundary_depth hops past the last RkNN, a sample_rate share of the points cut off there is
+    # verified exactly, and the traversal stops once budget seconds have passed.
+    def __init__(self, budget=None, boundary_depth=1, sample_rate=0.1, seed=None):
+        if budget is not None and budget <= 0:
+            raise ValueError(f'budget must be positive, got {budget}')
+        if boundary_depth < 0:
+            raise ValueError(f'boundary_depth must be non-negative, got {boundary_depth}')
+        if not 0 <= sample_rate <= 1:
+            raise ValueError(f'sample_rate must be in [0, 1], got {sample_rate}')
+        self.budget = budget
+        self.boundary_depth = boundary_depth
+        self.sample_rate = sample_rate
+        self.random = random.Random(seed)
+        self.deadline = None
+        self.results = 0
+        self.exact = 0
+        self.estimated_positives = 0
+        self.estimated_negatives = 0
+        self.sampled_positives = 0
+        self.sampled_negatives = 0
+        self.false_positives = 0
+        self.false_negatives = 0
+        # relative margins between the distance to q and the estimated radius of the points decided by estimates,
+        # and relative errors of the same estimate for the points whose exact radius is known
+        self.positive_margins = []
+        self.negative_margins = []
+        self.residuals = []
+        self.cut_off = 0
+        self.cut_sampled = 0
+        self.cut_positives = 0
+        self.unexplored = 0
+        self.timed_out = False
+        self.expected_results = 0
+
+    def start(self):
+        self.deadline = None if self.budget is None else time.perf_counter() + self.budget
+
+    def expect(self, expected_results):
+        self.expected_results += expected_results
+
+    @property
+    def expired(self):
+        return self.deadline is not None and time.perf_counter() >= self.deadline
+
+    def isRkNN(self, p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
+        result = settle(p, q, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal)
+        if result is None:
+            result = self.decide(p, q, k, index, positive_dict, negative_dict, knn_radius_dict, dist_cal)
         else:
-            return self.cache[(p1, p2)]
+            self.exact += 1
+        if result:
+            self.results += 1
+        return result
+
+    def decide(self, p, q, k, index, positive_dict, negative_dict, knn_radius_dict, dist_cal):
+        r = knn_radius_dict.get(p.id)
+        if r is None:
+            r = index.precomputed_knn_radius(p, k)
+        if r is not None:
+            self.exact += 1
+            return judge(p, q, r, positive_dict, negative_dict, knn_radius_dict, dist_cal)
+        dist_q = dist_cal.dist(p, q)
+        lower, upper, estimate = self.bounds(p, knn_radius_dict, dist_cal)
+        if dist_q <= lower or dist_q > upper:
+            self.exact += 1
+            return dist_q <= lower
+        guess = estimate is not None and dist_q <= estimate
+        if estimate is not None and self.random.random() >= self.sample_rate:
+            # decided by the estimate, which is kept out of the discriminant dicts
+            margin = abs(dist_q - estimate) / estimate if estimate > 0 else float('inf')
+            if guess:
+                self.estimated_positives += 1
+                self.positive_margins.append(margin)
+            else:
+                self.estimated_negatives += 1
+                self.negative_margins.append(margin)
+            return guess
+        self.exact += 1
+        result = judge(p, q, kNNRadius(p, k, index), positive_dict, negative_dict, knn_radius_dict, dist_cal)
+        if estimate is not None:
+            if guess:
+                self.sampled_positives += 1
+                self.false_positives += not result
+            else:
+                self.sampled_negatives += 1
+                self.false_negatives += result
+        return result
+
+    def bounds(self, p, knn_radius_dict, dist_cal):
+        # the kNN radii of p and of a neighbour differ by at most the distance between them
+        lower, upper, radii = 0, float('inf'), []
+        nodes = p.tree.nodes
+        for neighbor_id in p.neighbor_ids:
+            r = knn_radius_dict.get(neighbor_id)
+            if r is not None:
+                d = dist_cal.dist(p, nodes[neighbor_id])
+                lower = max(lower, r - d)
+                upper = min(upper, r + d)
+                radii.append(r)
+        return lower, upper, sum(radii) / len(radii) if len(radii) > 0 else None
+
+    def calibrate(self, nodes, point_ids, knn_radius_dict):
+        # the error the neighbour mean makes on the points of the query whose exact radius is known
+        for point_id in point_ids:
+            r = knn_radius_dict.get(point_id)
+            if r is None:
+                continue
+            radii = [knn_radius_dict[neighbor_id] for neighbor_id in nodes[point_id].neighbor_ids
+                     if neighbor_id in knn_radius_dict]
+            if len(radii) > 0 and sum(radii) > 0:
+                estimate = sum(radii) / len(radii)
+                self.residuals.append((r - estimate) / estimate)
+
+    @property
+    def estimate_error(self):
+        # root mean square of the relative errors of the radius estimates
+        if len(self.residuals) == 0:
+            return None
+        return sqrt(sum(e * e for e in self.residuals) / len(self.residuals))
+
+    def expected_errors(self, margins):
+        # with the errors of the estimates spread normally, a decision is wrong when the error exceeds its margin
+        if len(self.residuals) < 2:
+            return None
+        sd = self.estimate_error
+        if sd == 0:
+            return 0.0
+        return sum(0.5 * (1 - erf(margin / sd / sqrt(2))) for margin in margins)
+
+    @property
+    def statistics(self):
+        # Precision and recall are estimated from the margins of the estimated decisions against the spread of the
+        # estimate errors, or from the error rates of the sampled estimates while too few errors are known. The
+        # RkNNs cut off by boundary_depth are estimated at the rate found in the sample of them, and when the budget
+        # runs out, the RkNNs never reached are taken from the mean RkNN size, k times the number of points per
+        # facility.
+        false_positives = self.expected_errors(self.positive_margins)
+        missed = self.expected_errors(self.negative_margins)
+        if false_positives is None:
+            fp_rate = self.false_positives / self.sampled_positives if self.sampled_positives > 0 else 0.0
+            fn_rate = self.false_negatives / self.sampled_negatives if self.sampled_negatives > 0 else 0.0
+            false_positives = self.estimated_positives * fp_rate
+            missed = self.estimated_negatives * fn_rate
+        true_positives = self.results - false_positives
+        if self.cut_sampled > 0:
+            missed += self.cut_off * self.cut_positives / self.cut_sampled
+        if self.timed_out:
+            missed = max(missed, self.expected_results - true_positives)
+        return {'results': self.results, 'exact': self.exact, 'estimated_positives': self.estimated_positives,
+                'estimated_negatives': self.estimated_negatives,
+                'sampled': self.sampled_positives + self.sampled_negatives,
+                'false_positives': self.false_positives, 'false_negatives': self.false_negatives,
+                'estimate_error': self.estimate_error, 'cut_off': self.cut_off, 'cut_sampled': self.cut_sampled,
+                'cut_positives': self.cut_positives,
+                'unexplored': self.unexplored, 'timed_out': self.timed_out,
+                'precision': true_positives / self.results if self.results > 0 else 1.0,
+                'recall': true_positives / (true_positives + missed) if true_positives + missed > 0 else 1.0}
 
 
 def isRkNN(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
-    if p in positive_dict:
+    result = settle(p, q, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal)
+    if result is not None:
+        return result
+    r = knn_radius_dict.get(p.id)
+    if r is None:
+        r = kNNRadius(p, k, index)
+    return judge(p, q, r, positive_dict, negative_dict, knn_radius_dict, dist_cal)
+
+
+def settle(p, q, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
+    # the discriminant dicts are keyed by node id, their values are the discriminant nodes
+    if p.id in positive_dict:
         return True
-    if p in negative_dict:
+    if p.id in negative_dict:
         return False
     if dist_cal.dist(p, q) <= semi_r_q:
         return True
-    for neighbor in p.neighbors:
-        if neighbor in positive_dict:
-            p_disc = positive_dict[neighbor]
-            if dist_cal.dist(p, q) + dist_cal.dist(p, p_disc) <= knn_radius_dict[p_disc]:
-                positive_dict[p] = p_disc
+    if p.id in knn_radius_dict:
+        # known from an earlier query of the same group, judging p costs less than the discriminants
+        return None
+    for neighbor_id in p.neighbor_ids:
+        if neighbor_id in positive_dict:
+            p_disc = positive_dict[neighbor_id]
+            if dist_cal.dist(p, q) + dist_cal.dist(p, p_disc) <= knn_radius_dict[p_disc.id]:
+                positive_dict[p.id] = p_disc
+                return True
+        if neighbor_id in negative_dict:
+            p_disc = negative_dict[neighbor_id]
+            if dist_cal.dist(p, q) - dist_cal.dist(p, p_disc) > knn_radius_dict[p_disc.id]:
+                negative_dict[p.id] = p_disc
+                return False
+        if neighbor_id in knn_radius_dict and neighbor_id not in positive_dict and neighbor_id not in negative_dict:
+            # a radius left behind by an earlier query of the same group discriminates for this query as well
+            p_disc = p.tree.nodes[neighbor_id]
+            if dist_cal.dist(p, q) + dist_cal.dist(p, p_disc) <= knn_radius_dict[neighbor_id]:
+                positive_dict[p.id] = p_disc
                 return True
-        if neighbor in negative_dict:
-            p_disc = negative_dict[neighbor]
-            if dist_cal.dist(p, q) - dist_cal.dist(p, p_disc) > knn_radius_dict[p_disc]:
-                negative_dict[p] = p_disc
+            if dist_cal.dist(p, q) - dist_cal.dist(p, p_disc) > knn_radius_dict[neighbor_id]:
+                negative_dict[p.id] = p_disc
                 return False
-    r = kNNRadius(p, k, index)
-    knn_radius_dict[p] = r
+    return None
+
+
+def judge(p, q, r, positive_dict, negative_dict, knn_radius_dict, dist_cal):
+    knn_radius_dict[p.id] = r
     if dist_cal.dist(p, q) <= r:
-        positive_dict[p] = p
+        positive_dict[p.id] = p
         return True
     else:
-        negative_dict[p] = p
+        negative_dict[p.id] = p
         return False
 
 
+def resolve(ps, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal, pool):
+    # settles ps through the discriminants and computes the kNN radii of the rest in a single batch
+    pending = dict()
+    for p in ps:
+        if p.id not in pending and settle(p, q, semi_r_q, positive_dict, negative_dict, knn_radius_dict,
+                                          dist_cal) is None:
+            pending[p.id] = p
+    known = [p for p in pending.values() if p.id in knn_radius_dict]
+    for p in known:
+        judge(p, q, knn_radius_dict[p.id], positive_dict, negative_dict, knn_radius_dict, dist_cal)
+    pending = [p for p in pending.values() if p.id not in knn_radius_dict]
+    for p, r in zip(pending, kNNRadii(pending, k, index, pool)):
+        judge(p, q, r, positive_dict, negative_dict, knn_radius_dict, dist_cal)
+
+
 def may_be_boundary_point(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
     for neighbor in p.neighbors:
         if isRkNN(neighbor, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
@@ -50,13 +282,13 @@ def may_be_boundary_point(p, q, k, index, semi_r_q, positive_dict, negative_dict
 
 
 def share_negative_disc_point(p, q, other, negative_dict, knn_radius_dict, dist_cal):
-    disc_p = negative_dict[p]
-    disc_other = negative_dict[other]
-    if disc_p is disc_other:
+    disc_p = negative_dict[p.id]
+    disc_other = negative_dict[other.id]
+    if disc_p.id == disc_other.id:
         return True
-    if dist_cal.dist(p, q) - dist_cal.dist(p, disc_other) > knn_radius_dict[disc_other]:
+    if dist_cal.dist(p, q) - dist_cal.dist(p, disc_other) > knn_radius_dict[disc_other.id]:
         return True
-    if dist_cal.dist(other, q) - dist_cal.dist(other, disc_p) > knn_radius_dict[disc_p]:
+    if dist_cal.dist(other, q) - dist_cal.dist(other, disc_p) > knn_radius_dict[disc_p.id]:
         return True
     return False
 
@@ -64,59 +296,236 @@ def share_negative_disc_point(p, q, other, negative_dict, knn_radius_dict, dist_
 def kNNRadius(q, k, index):
     if k == 0:
         return 0
+    r = index.precomputed_knn_radius(q, k)
+    if r is not None:
+        return r
     knn = list(index.nearest(q, k))
     return knn[-1][1]
 
 
-def MonoRkNN(q, k, index):
-    r_q = kNNRadius(q, k, index)
-    semi_r_q = r_q / 2
-    dist_cal = DistanceCalculator()
+def kNNRadii(qs, k, index, pool=None):
+    if len(qs) == 0:
+        return []
+    return index.knn_radii(qs, k, pool)
+
+
+def expand(p, visited, candidates):
+    # visited holds node ids, so unvisited neighbours are found without fetching the neighbour nodes, returns the
+    # number of nodes fetched
+    nodes = p.tree.nodes
+    count = 0
+    for neighbor_id in p.neighbor_ids:
+        if neighbor_id not in visited:
+            visited.add(neighbor_id)
+            candidates.append(nodes[neighbor_id])
+            count += 1
+    return count
+
+
+def expand_in_batches(q, k, index, semi_r_q, candidates, visited, positive_dict, negative_dict, knn_radius_dict,
+                      dist_cal, control):
+    # same traversal as MonoRkNN/BiRkNN, but candidates are verified a whole frontier at a time so that their
+    # kNN radii, and those of the neighbours needed by may_be_boundary_point, are computed in one batch
+    pool = SitePool(index, q)
+    while len(candidates) > 0:
+        resolve(candidates, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal, pool)
+        negatives = [p for p in candidates if p.id in negative_dict]
+        resolve([neighbor for p in negatives for neighbor in p.neighbors], q, k, index, semi_r_q, positive_dict,
+                negative_dict, knn_radius_dict, dist_cal, pool)
+        frontier = list()
+        for p in candidates:
+            control.visit()
+            if isRkNN(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
+                yield p
+            elif not may_be_boundary_point(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict,
+                                           dist_cal):
+                continue
+            control.load(expand(p, visited, frontier))
+        candidates = frontier
+
+
+def expand_approximately(q, k, index, semi_r_q, candidates, visited, positive_dict, negative_dict, knn_radius_dict,
+                         dist_cal, approximation, control):
+    # same traversal as MonoRkNN/BiRkNN with approximation deciding the points, gaps holds the number of negative
+    # points between a pending candidate and the last RkNN on its way. The neighbours cut off by boundary_depth are
+    # collected in cut, once the traversal runs dry a sample of them is verified exactly, which measures how many
+    # RkNNs the cut misses, and the traversal resumes from the sampled RkNNs.
+    if len(candidates) == 0:
+        return
+    point_index = candidates[0].tree
+    if point_index is not index and approximation.budget is not None and not approximation.expired:
+        # k per facility times the users per facility around q, the k-th nearest facility of q and q itself, only
+        # needed to tell how many RkNNs a query cut short by the budget misses, and counted within the budget
+        approximation.expect(k * point_index.count_closer_than(q, kNNRadius(q, k, index)) / (k + 1))
+    else:
+        approximation.expect(k)
+    nodes = point_index.nodes
+    gaps = {p.id: 0 for p in candidates}
+    cut = dict()
+    unsampled = set()
+
+    def push_neighbors(p, gap):
+        for neighbor_id in p.neighbor_ids:
+            if neighbor_id not in visited:
+                visited.add(neighbor_id)
+                gaps[neighbor_id] = gap
+                candidates.append(nodes[neighbor_id])
+                control.load()
+            elif neighbor_id in gaps:
+                gaps[neighbor_id] = min(gaps[neighbor_id], gap)
+
+    while True:
+        while len(candidates) > 0:
+            if approximation.expired:
+                approximation.timed_out = True
+                approximation.unexplored += len(candidates)
+                approximation.calibrate(nodes, visited, knn_radius_dict)
+                return
+            control.visit()
+            p = candidates.pop()
+            gap = gaps.pop(p.id)
+            if approximation.isRkNN(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict,
+                                    dist_cal):
+                yield p
+                push_neighbors(p, 0)
+            elif gap < approximation.boundary_depth:
+                push_neighbors(p, gap + 1)
+            else:
+                for neighbor_id in p.neighbor_ids:
+                    if neighbor_id not in visited:
+                        cut[neighbor_id] = None
+        cut_ids = [neighbor_id for neighbor_id in cut if neighbor_id not in visited]
+        cut.clear()
+        if len(cut_ids) == 0 or approximation.sample_rate == 0:
+            unsampled.update(cut_ids)
+            break
+        sample = approximation.random.sample(cut_ids, ceil(approximation.sample_rate * len(cut_ids)))
+        unsampled.update(set(cut_ids).difference(sample))
+        for neighbor_id in sample:
+            if approximation.expired:
+                break
+            control.visit()
+            visited.add(neighbor_id)
+            p = nodes[neighbor_id]
+            control.load()
+            approximation.exact += 1
+            approximation.cut_sampled += 1
+            if isRkNN(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
+                approximation.cut_positives += 1
+                approximation.results += 1
+                yield p
+                push_neighbors(p, 0)
+    # the cut off points that the resumed traversal never reached
+    approximation.cut_off += len(unsampled.difference(visited))
+    approximation.calibrate(nodes, visited, knn_radius_dict)
+
+
+def MonoRkNN(q, k, index, batch=False, dist_cal=None, knn_radius_dict=None, approximation=None, control=None):
+    # knn_radius_dict may be shared by queries with the same k and index, see GroupMonoRkNN, an Approximation
+    # trades exactness for latency and a QueryControl bounds the query, see rknn.query
+    if control is None:
+        control = QueryControl()
+    if approximation is not None:
+        approximation.start()
+    if knn_radius_dict is None:
+        knn_radius_dict = dict()
+    if q.id not in knn_radius_dict:
+        knn_radius_dict[q.id] = kNNRadius(q, k, index)
+    semi_r_q = knn_radius_dict[q.id] / 2
+    if dist_cal is None:
+        dist_cal = DistanceCalculator()
     positive_dict = dict()
     negative_dict = dict()
-    knn_radius_dict = dict()
     candidates = list()
-    visited = {q}
-    for neighbor in q.neighbors:
-        candidates.append(neighbor)
-        visited.add(neighbor)
+    visited = {q.id}
+    control.load(expand(q, visited, candidates))
+    if approximation is not None:
+        yield from expand_approximately(q, k, index, semi_r_q, candidates, visited, positive_dict, negative_dict,
+                                        knn_radius_dict, dist_cal, approximation, control)
+        return
+    if batch:
+        yield from expand_in_batches(q, k, index, semi_r_q, candidates, visited, positive_dict, negative_dict,
+                                     knn_radius_dict, dist_cal, control)
+        return
     while len(candidates) > 0:
+        control.visit()
         p = candidates.pop()
         if isRkNN(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
             yield p
-            for neighbor in p.neighbors:
-                if neighbor not in visited:
-                    visited.add(neighbor)
-                    candidates.append(neighbor)
+            control.load(expand(p, visited, candidates))
         elif may_be_boundary_point(p, q, k, index, semi_r_q, positive_dict, negative_dict, knn_radius_dict,
                                    dist_cal):
-            for neighbor in p.neighbors:
-                if neighbor not in visited:
-                    visited.add(neighbor)
-                    candidates.append(neighbor)
+            control.load(expand(p, visited, candidates))
 
 
-def BiRkNN(q, k, facility_index, user_index):
+def BiRkNN(q, k, facility_index, user_index, batch=False, dist_cal=None, knn_radius_dict=None, approximation=None,
+           control=None):
+    # knn_radius_dict holds the kNN radii of users and may be shared by queries with the same k, see GroupBiRkNN
+    if control is None:
+        control = QueryControl()
+    if approximation is not None:
+        approximation.start()
     r_q = kNNRadius(q, k - 1, facility_index)
     semi_r_q = r_q / 2
-    dist_cal = DistanceCalculator()
+    if dist_cal is None:
+        dist_cal = DistanceCalculator()
+    if knn_radius_dict is None:
+        knn_radius_dict = dict()
     positive_dict = dict()
     negative_dict = dict()
-    knn_radius_dict = dict()
     nn, nn_dist = list(user_index.nearest(q))[0]
     candidates = [nn]
-    visited = {nn}
+    visited = {nn.id}
+    control.load()
+    if approximation is not None:
+        yield from expand_approximately(q, k, facility_index, semi_r_q, candidates, visited, positive_dict,
+                                        negative_dict, knn_radius_dict, dist_cal, approximation, control)
+        return
+    if batch:
+        yield from expand_in_batches(q, k, facility_index, semi_r_q, candidates, visited, positive_dict,
+                                     negative_dict, knn_radius_dict, dist_cal, control)
+        return
     while len(candidates) > 0:
+        control.visit()
         p = candidates.pop()
         if isRkNN(p, q, k, facility_index, semi_r_q, positive_dict, negative_dict, knn_radius_dict, dist_cal):
             yield p
-            for neighbor in p.neighbors:
-                if neighbor not in visited:
-                    visited.add(neighbor)
-                    candidates.append(neighbor)
+            control.load(expand(p, visited, candidates))
         elif may_be_boundary_point(p, q, k, facility_index, semi_r_q, positive_dict, negative_dict, knn_radius_dict,
                                    dist_cal):
-            for neighbor in p.neighbors:
-                if neighbor not in visited:
-                    visited.add(neighbor)
-                    candidates.append(neighbor)
+            control.load(expand(p, visited, candidates))
+
+
+def GroupMonoRkNN(qs, k, index, batch=False, dist_cal=None):
+    # Answers the Mono-RkNN queries of qs one after another and yields (q, result) pairs. The kNN radius of a point
+    # does not depend on the query, so the radii and distances computed for one query settle the points it shares
+    # with the later ones.
+    if dist_cal is None:
+        dist_cal = DistanceCalculator()
+    knn_radius_dict = dict()
+    for q in qs:
+        yield q, list(MonoRkNN(q, k, index, batch, dist_cal, knn_radius_dict))
+
+
+def GroupBiRkNN(qs, k, facility_index, user_index, batch=False, dist_cal=None):
+    if dist_cal is None:
+        dist_cal = DistanceCalculator()
+    knn_radius_dict = dict()
+    for q in qs:
+        yield q, list(BiRkNN(q, k, facility_index, user_index, batch, dist_cal, knn_radius_dict))
+
+
+def InfluenceSets(k, facility_index, user_index=None):
+    # The RkNNs of every facility, as a dict from facility ids to the ids of their RkNNs (users when user_index is
+    # given). A point is an RkNN of exactly the facilities within its kNN radius, so a single pass over the points
+    # that inverts their kNN sets answers all the queries at once.
+    if k <= 0:
+        raise ValueError(f'k must be positive, got {k}')
+    facilities = facility_index.data_nodes()
+    points = facilities if user_index is None else user_index.data_nodes()
+    uuids = {f.id: f.uuid for f in facilities}
+    influence = {f.uuid: [] for f in facilities}
+    for p, site_ids in zip(points, facility_index.knn_sets(points, k, facilities)):
+        for site_id in site_ids:
+            influence[uuids[site_id]].append(p.uuid)
+    return influence
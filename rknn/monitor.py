@@ -0,0 +1,166 @@
+from index.rtree import distance
+from rknn import csd
+
+
+class RkNNMonitor(object):
+    # Standing RkNN queries over a facility index, and a user index for Bi-RkNN, kept up to date as points are
+    # inserted, deleted and moved through the monitor. Every event updates the indices and returns, for the queries
+    # whose result changed, the external ids that entered and left it.
+    #
+    # Only points whose k-th nearest facility can change are verified again. A new facility f can only push out
+    # current results that are closer to f than to q. Deleting f can only change the points that had f among their k
+    # nearest facilities, which are the RkNNs of f computed just before it goes.
+    def __init__(self, facility_index, user_index=None):
+        self.facility_index = facility_index
+        self.user_index = user_index
+        self.queries = dict()
+        self.next_query_id = 0
+
+    @property
+    def bichromatic(self):
+        return self.user_index is not None
+
+    def register(self, q_uuid, k):
+        if k <= 0:
+            raise ValueError(f'k must be positive, got {k}')
+        query_id = self.next_query_id
+        self.next_query_id += 1
+        self.queries[query_id] = (q_uuid, k, self.compute(q_uuid, k))
+        return query_id
+
+    def unregister(self, query_id):
+        del self.queries[query_id]
+
+    def result(self, query_id):
+        return set(self.queries[query_id][2])
+
+    def compute(self, q_uuid, k):
+        q = self.facility_index.lookup(q_uuid)
+        if self.bichromatic:
+            return {e.uuid for e in csd.BiRkNN(q, k, self.facility_index, self.user_index)}
+        return {e.uuid for e in csd.MonoRkNN(q, k, self.facility_index)}
+
+    def is_rknn(self, p, q, k):
+        # fewer than k facilities other than p are closer to p than q
+        return self.facility_index.count_closer_than(p, distance(*p.coords, *q.coords), k) < k
+
+    def rknn(self, f, k):
+        if self.bichromatic:
+            return {e.uuid for e in csd.BiRkNN(f, k, self.facility_index, self.user_index)}
+        return {e.uuid for e in csd.MonoRkNN(f, k, self.facility_index)}
+
+    def point_index(self):
+        return self.user_index if self.bichromatic else self.facility_index
+
+    def verify(self, query_id, uuids, deltas):
+        q_uuid, k, result = self.queries[query_id]
+        q = self.facility_index.lookup(q_uuid)
+        index = self.point_index()
+        for uuid in uuids:
+            if uuid == q_uuid or uuid not in index.ids:
+                continue
+            if self.is_rknn(index.lookup(uuid), q, k):
+                if uuid not in result:
+                    result.add(uuid)
+                    record(deltas, query_id, uuid, True)
+            elif uuid in result:
+                result.discard(uuid)
+                record(deltas, query_id, uuid, False)
+
+    def insert_facility(self, uuid, geom):
+        deltas = dict()
+        f = self.facility_index.insert(uuid, geom)
+        for query_id, (q_uuid, k, result) in list(self.queries.items()):
+            qx, qy = self.facility_index.lookup(q_uuid).coords
+            affected = []
+            for u in result:
+                x, y = self.point_index().lookup(u).coords
+                if distance(x, y, *f.coords) < distance(x, y, qx, qy):
+                    affected.append(u)
+            if not self.bichromatic:
+                affected.append(uuid)
+            self.verify(query_id, affected, deltas)
+        return deltas
+
+    def delete_facility(self, uuid):
+        deltas = dict()
+        f = self.facility_index.lookup(uuid)
+        affected = {k: self.rknn(f, k) for k in {k for q_uuid, k, result in self.queries.values() if q_uuid != uuid}}
+        self.facility_index.delete(f)
+        for query_id, (q_uuid, k, result) in list(self.queries.items()):
+            if q_uuid == uuid:
+                # the query facility is gone, and with it every result of the query
+                for u in result:
+                    record(deltas, query_id, u, False)
+                del self.queries[query_id]
+                continue
+            if uuid in result:
+                result.discard(uuid)
+                record(deltas, query_id, uuid, False)
+            self.verify(query_id, affected[k] - result, deltas)
+        return deltas
+
+    def move_facility(self, uuid, geom):
+        moved = [query_id for query_id, (q_uuid, k, result) in self.queries.items() if q_uuid == uuid]
+        saved = {query_id: self.queries.pop(query_id) for query_id in moved}
+        deltas = self.delete_facility(uuid)
+        merge(deltas, self.insert_facility(uuid, geom))
+        for query_id, (q_uuid, k, result) in saved.items():
+            # a moving query facility is answered again from scratch
+            new_result = self.compute(q_uuid, k)
+            for u in new_result - result:
+                record(deltas, query_id, u, True)
+            for u in result - new_result:
+                record(deltas, query_id, u, False)
+            self.queries[query_id] = (q_uuid, k, new_result)
+        return deltas
+
+    def insert_user(self, uuid, geom):
+        self.users_only()
+        deltas = dict()
+        self.user_index.insert(uuid, geom)
+        for query_id in list(self.queries):
+            self.verify(query_id, [uuid], deltas)
+        return deltas
+
+    def delete_user(self, uuid):
+        self.users_only()
+        deltas = dict()
+        self.user_index.delete(self.user_index.lookup(uuid))
+        for query_id, (q_uuid, k, result) in self.queries.items():
+            if uuid in result:
+                result.discard(uuid)
+                record(deltas, query_id, uuid, False)
+        return deltas
+
+    def move_user(self, uuid, geom):
+        deltas = self.delete_user(uuid)
+        merge(deltas, self.insert_user(uuid, geom))
+        return deltas
+
+    def users_only(self):
+        if not self.bichromatic:
+            raise ValueError('user events need a monitor created with a user index')
+
+
+def record(deltas, query_id, uuid, added):
+    # deltas maps a query id to (added ids, removed ids), a point that leaves and re-enters nets out
+    added_ids, removed_ids = deltas.setdefault(query_id, (set(), set()))
+    if added:
+        if uuid in removed_ids:
+            removed_ids.discard(uuid)
+        else:
+            added_ids.add(uuid)
+    else:
+        if uuid in added_ids:
+            added_ids.discard(uuid)
+        else:
+            removed_ids.add(uuid)
+
+
+def merge(deltas, other):
+    for query_id, (added_ids, removed_ids) in other.items():
+        for uuid in removed_ids:
+            record(deltas, query_id, uuid, False)
+        for uuid in added_ids:
+            record(deltas, query_id, uuid, True)
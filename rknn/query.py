@@ -0,0 +1,87 @@
+import time
+
+from rknn import csd, slice, vr
+from rknn.control import Cancellation, QueryControl, QueryStopped
+
+algorithms = {'csd': csd, 'slice': slice, 'vr': vr}
+
+
+class RkNNQuery(object):
+    # One RkNN query of any algorithm, Mono-RkNN unless a user index is given, run under a timeout in seconds, a
+    # limit on the number of results and a Cancellation. Iterating it streams the results as the algorithm finds them
+    # and ends without an error as soon as a limit is hit, stop_reason then tells which one ('complete', 'limit',
+    # 'deadline', 'cancelled', or 'closed' when the caller stopped iterating). progress can be read at any time,
+    # also from another thread.
+    def __init__(self, q, k, facility_index, user_index=None, algorithm='csd', timeout=None, limit=None,
+                 cancellation=None, **kwargs):
+        algorithm = algorithm.lower()
+        if algorithm not in algorithms:
+            raise ValueError(f'unknown RkNN algorithm {algorithm}, expected one of {sorted(algorithms)}')
+        if timeout is not None and timeout <= 0:
+            raise ValueError(f'timeout must be positive, got {timeout}')
+        if limit is not None and limit < 0:
+            raise ValueError(f'limit must be non-negative, got {limit}')
+        self.q = q
+        self.k = k
+        self.facility_index = facility_index
+        self.user_index = user_index
+        self.algorithm = algorithm
+        self.timeout = timeout
+        self.limit = limit
+        self.cancellation = Cancellation() if cancellation is None else cancellation
+        self.kwargs = kwargs
+        self.control = QueryControl(cancellation=self.cancellation)
+        self.results = 0
+        self.started = None
+        self.finished = None
+        self.stop_reason = None
+
+    def __iter__(self):
+        if self.started is not None:
+            raise ValueError('an RkNNQuery can only be iterated once')
+        self.started = time.monotonic()
+        if self.timeout is not None:
+            self.control.deadline = self.started + self.timeout
+        try:
+            if self.limit == 0:
+                self.stop_reason = 'limit'
+                return
+            if self.user_index is None:
+                result = algorithms[self.algorithm].MonoRkNN(self.q, self.k, self.facility_index,
+                                                             control=self.control, **self.kwargs)
+            else:
+                result = algorithms[self.algorithm].BiRkNN(self.q, self.k, self.facility_index, self.user_index,
+                                                           control=self.control, **self.kwargs)
+            try:
+                for e in result:
+                    self.results += 1
+                    yield e
+                    if self.limit is not None and self.results >= self.limit:
+                        self.stop_reason = 'limit'
+                        return
+                    # the caller may have spent the rest of the time, or cancelled, while it held the result
+                    self.control.check()
+                self.stop_reason = 'complete'
+            finally:
+                result.close()
+        except QueryStopped:
+            self.stop_reason = self.control.stop_reason
+        except GeneratorExit:
+            self.stop_reason = 'closed'
+            raise
+        finally:
+            self.finished = time.monotonic()
+
+    def cancel(self):
+        self.cancellation.cancel()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished if self.finished is not None else time.monotonic()) - self.started
+
+    @property
+    def progress(self):
+        return {'results': self.results, 'candidates_visited': self.control.visited,
+                'nodes_loaded': self.control.loaded, 'elapsed': self.elapsed, 'stop_reason': self.stop_reason}
@@ -1,185 +1,315 @@
-from math import acos
+from bisect import bisect_left
+from math import atan2, log10
+from numbers import Integral
 
-from numpy.linalg import norm
-from shapely.geometry import Point, Polygon
 import numpy as np
-from shapely.ops import unary_union
 from math import cos, pi, sin
 
-from common.data_structure import MinHeap
+from common.data_structure import MinHeap, NSmallestHolder
+from index.rtree import area, distance, mbr_min_dists
+from rknn.control import QueryControl
 
 
-def angle(o, x, y):
-    x = np.asarray(x)
-    y = np.asarray(y)
-    o = np.asarray(o)
-    vector_ox = x - o
-    vector_oy = y - o
-    norm_ox = norm(vector_ox)
-    norm_oy = norm(vector_oy)
-    if norm_ox == 0 or norm_oy == 0:
-        return 0
-    return acos(vector_ox.dot(vector_oy) / (norm_ox * norm_oy))
+def mbr_min_dist(bounds, o):
+    dx = max(bounds[0] - o[0], o[0] - bounds[2], 0)
+    dy = max(bounds[1] - o[1], o[1] - bounds[3], 0)
+    return distance(dx, dy, 0, 0)
 
 
-class Circle(Polygon):
+def angle(directions, a):
+    # angles in [0, pi] between directions and the ray at angle a
+    return np.abs((directions - a + pi) % (2 * pi) - pi)
+
+
+def inWedge(directions, start, end, margin=0.0):
+    return ((directions - start + margin) % (2 * pi)) <= end - start + 2 * margin
+
+
+def clip(polygon, a, b, c):
+    # the part of a convex polygon where a * x + b * y + c >= 0
+    result = []
+    for i in range(len(polygon)):
+        p, q = polygon[i - 1], polygon[i]
+        fp = a * p[0] + b * p[1] + c
+        fq = a * q[0] + b * q[1] + c
+        if (fp < 0) != (fq < 0):
+            t = fp / (fp - fq)
+            result.append((p[0] + t * (q[0] - p[0]), p[1] + t * (q[1] - p[1])))
+        if fq >= 0:
+            result.append(q)
+    return result
+
+
+def segment_distance(o, p, q):
+    dx, dy = q[0] - p[0], q[1] - p[1]
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else min(max(((o[0] - p[0]) * dx + (o[1] - p[1]) * dy) / length, 0), 1)
+    return distance(o[0], o[1], p[0] + t * dx, p[1] + t * dy)
+
+
+class Circle:
+    # closed disk, compared against MBRs (minx, miny, maxx, maxy); a circle of radius 0 is empty
     def __init__(self, o, r):
-        if r > 0:
-            Polygon.__init__(self, o.buffer(r).exterior.coords)
-        else:
-            Polygon.__init__(self)
         self.o = o
         self.r = r
 
+    def intersects(self, bounds):
+        if self.r <= 0:
+            return False
+        return mbr_min_dist(bounds, self.o) <= self.r
+
+    def containsPoints(self, xs, ys):
+        dx = xs - self.o[0]
+        dy = ys - self.o[1]
+        return (np.sqrt(dx * dx + dy * dy) <= self.r) & (self.r > 0)
 
-class Sector(Polygon):
+
+class Sector:
+    # closed sector swept counterclockwise from angles[0] to angles[1] around o, a sector of radius 0 is empty
     def __init__(self, o, r, angles):
-        if r > 0:
-            circle = o.buffer(r)
-            if abs(angles[0] - angles[1]) >= pi:
-                raise ValueError('abs(angles[0] - angles[1]) must be less than Pi')
-            l = r / cos(abs(angles[0] - angles[1]) / 2)
-            triangle = Polygon(
-                [(o.x, o.y), (o.x + cos(angles[0]) * l, o.y + sin(angles[0]) * l),
-                 (o.x + cos(angles[1]) * l, o.y + sin(angles[1]) * l)])
-            sector = triangle.intersection(circle)
-            Polygon.__init__(self, sector.exterior.coords)
-            self.arcVertices = list(triangle.exterior.intersection(circle.exterior))
-        else:
-            Polygon.__init__(self)
-            self.arcVertices = [o, o]
+        if abs(angles[0] - angles[1]) >= pi:
+            raise ValueError('abs(angles[0] - angles[1]) must be less than Pi')
         self.o = o
         self.r = r
         self.angles = angles
+        self.arcVertices = [(o[0] + r * cos(a), o[1] + r * sin(a)) for a in angles]
+
+    def intersects(self, bounds):
+        if self.r <= 0 or mbr_min_dist(bounds, self.o) > self.r:
+            return False
+        minx, miny, maxx, maxy = bounds
+        ox, oy = self.o
+        if minx <= ox <= maxx and miny <= oy <= maxy:
+            return True
+        # clip the MBR to the wedge, widened by a rounding margin, and measure how far the rest is from o
+        margin = 1e-9 * self.r
+        polygon = [(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)]
+        start, end = min(self.angles), max(self.angles)
+        polygon = clip(polygon, -sin(start), cos(start), sin(start) * ox - cos(start) * oy + margin)
+        polygon = clip(polygon, sin(end), -cos(end), cos(end) * oy - sin(end) * ox + margin)
+        if len(polygon) == 0:
+            return False
+        return min(segment_distance(self.o, polygon[i - 1], polygon[i]) for i in range(len(polygon))) <= self.r
+
+    def containsPoints(self, xs, ys):
+        dx = xs - self.o[0]
+        dy = ys - self.o[1]
+        inside = inWedge(np.arctan2(dy, dx), min(self.angles), max(self.angles), 1e-9)
+        return inside & (np.sqrt(dx * dx + dy * dy) <= self.r) & (self.r > 0)
+
+
+class Union:
+    def __init__(self, areas):
+        self.areas = areas
+
+    def intersects(self, bounds):
+        for area in self.areas:
+            if area.intersects(bounds):
+                return True
+        return False
+
+    def containsPoints(self, xs, ys):
+        inside = np.zeros(len(xs), dtype=bool)
+        for area in self.areas:
+            inside |= area.containsPoints(xs, ys)
+        return inside
 
 
 class Partition(Sector):
+    # During filtering the unpruned areas are only recomputed once the k-th smallest upper radius has shrunk below
+    # updateRatio times the current bound. A looser bound only leaves more space unpruned, and filtering ends with an
+    # exact update.
+    updateRatio = 0.99
+
     def __init__(self, o, r, angles, k):
         Sector.__init__(self, o, r, angles)
         self.k = k
-        self.upperRadiusList = list()
+        self.upperRadii = NSmallestHolder(k)
         self.sigList = list()
         self.boundingUpperRadius = self.r
         self.userUnprunedArea, self.facilityUnprunedArea = self.calculateUnprunedArea(self.boundingUpperRadius)
         self.updateUnprunedArea()
 
-    def updateUnprunedArea(self):
-        if len(self.upperRadiusList) >= self.k and self.upperRadiusList[-1] < self.boundingUpperRadius:
-            self.boundingUpperRadius = self.upperRadiusList[-1]
-            self.userUnprunedArea = Sector(self.o, self.boundingUpperRadius, self.angles)
-            self.userUnprunedArea, self.facilityUnprunedArea = self.calculateUnprunedArea(self.boundingUpperRadius)
+    def updateUnprunedArea(self, exact=False):
+        if self.upperRadii.is_full():
+            upperRadius = self.upperRadii.largest()
+            if upperRadius < self.boundingUpperRadius * (1 if exact else self.updateRatio):
+                self.boundingUpperRadius = upperRadius
+                self.userUnprunedArea, self.facilityUnprunedArea = self.calculateUnprunedArea(upperRadius)
 
     def calculateUnprunedArea(self, boundingUpperRadius):
         userUnprunedArea = Sector(self.o, boundingUpperRadius, self.angles)
-        facilityUnprunedArea = unary_union(
+        facilityUnprunedArea = Union(
             [Circle(userUnprunedArea.arcVertices[0], boundingUpperRadius),
              Circle(userUnprunedArea.arcVertices[1], boundingUpperRadius),
              Sector(self.o, boundingUpperRadius * 2, self.angles)])
         return userUnprunedArea, facilityUnprunedArea
 
-    def addUpperRadius(self, upperRadius):
-        if len(self.upperRadiusList) < self.k:
-            self.upperRadiusList.append(upperRadius)
-            if len(self.upperRadiusList) == self.k:
-                self.upperRadiusList.sort()
-                self.updateUnprunedArea()
-        elif upperRadius < self.upperRadiusList[-1]:
-            self.upperRadiusList.append(upperRadius)
-            self.upperRadiusList.sort()
-            self.upperRadiusList.pop()
-            self.updateUnprunedArea()
-
-    def getMinMaxAngle(self, p):
-        o = (self.o.x, self.o.y)
-        p1 = [o[0] + cos(self.angles[0]), o[1] + sin(self.angles[0])]
-        p2 = [o[0] + cos(self.angles[1]), o[1] + sin(self.angles[1])]
-        angles = [angle(o, p1, p), angle(o, p2, p)]
-        return sorted(angles)
+    def addUpperRadii(self, upperRadii):
+        if self.upperRadii.is_full():
+            upperRadii = upperRadii[upperRadii < self.upperRadii.largest()]
+        for upperRadius in upperRadii.tolist():
+            if not self.upperRadii.is_full() or upperRadius < self.upperRadii.largest():
+                self.upperRadii.push(upperRadius)
+        self.updateUnprunedArea()
+
+    def sortSigList(self):
+        # sigList sorted by lower radius, with the radii, coordinates and ids of its facilities as arrays
+        self.sigList.sort(key=lambda e: e[0])
+        self.lowerRadii = [lowerRadius for lowerRadius, f in self.sigList]
+        self.sigCoords = np.array([f.coords for lowerRadius, f in self.sigList], dtype=float).reshape(-1, 2)
+        self.sigIds = np.array([f.id for lowerRadius, f in self.sigList], dtype=np.int64)
+        self.sigTree = self.sigList[0][1].tree if len(self.sigList) > 0 else None
 
 
 def getPartitions(o, index, n, k):
-    bounds = index.root.geom.bounds
-    r = Point((bounds[0], bounds[1])).distance(Point((bounds[2], bounds[3])))
+    bounds = index.root.bounds
+    r = distance(bounds[0], bounds[1], bounds[2], bounds[3])
     return [Partition(o, r, [2 * pi / n * i, 2 * pi / n * (i + 1)], k) for i in range(n)]
 
 
+def adaptivePartitionNum(q, k, index):
+    # two more partitions per order of magnitude of k, as long as a partition of the space around q still holds
+    # about k facilities, the kNN radius of q is estimated from the density of its leaf instead of being searched
+    n = 6 + 2 * int(log10(k)) if k > 0 else 6
+    path = index.root.find_leaf(q) if k > 0 and q.tree is index else None
+    if path is not None:
+        leaf = path[-1]
+        leaf_area = area(leaf.bounds)
+        if leaf_area > 0:
+            bounds = index.root.bounds
+            r = distance(bounds[0], bounds[1], bounds[2], bounds[3])
+            n = min(n, int(r * r * pi * leaf.children_num / (k * leaf_area)))
+    return max(3, min(n, 16))
+
+
+def partitionNum(q, k, index, partition_num):
+    if partition_num == 'auto':
+        return adaptivePartitionNum(q, k, index)
+    if not isinstance(partition_num, Integral) or partition_num < 3:
+        raise ValueError(f'partition_num must be auto or an integer of at least 3, got {partition_num}')
+    return int(partition_num)
+
+
 def isPruned(e, facilityUnprunedAreas):
+    if e.bounds is None:
+        return True
     for area in facilityUnprunedAreas:
-        if e.geom.intersects(area):
+        if area.intersects(e.bounds):
             return False
     return True
 
 
-def pruneSpace(f, partitions):
-    for partition in partitions:
-        minAngle, maxAngle = partition.getMinMaxAngle(f.geom)
-        if minAngle < pi / 2:
-            dist = f.geom.distance(partition.o)
-            if maxAngle >= pi / 2:
-                partition.addUpperRadius(float('inf'))
-            else:
-                partition.addUpperRadius(dist / (2 * cos(maxAngle)))
-            if f.geom.intersects(partition.facilityUnprunedArea):
-                lowerRadius = dist / (2 * cos(minAngle))
-                partition.sigList.append([lowerRadius, f])
+def getMinMaxAngles(o, coords, partitions):
+    # smallest and largest angle between the direction of every facility from o and the directions covered by every
+    # partition, as arrays of shape (facilities, partitions)
+    dx = coords[:, 0] - o[0]
+    dy = coords[:, 1] - o[1]
+    directions = np.arctan2(dy, dx)[:, None]
+    starts = np.array([min(p.angles) for p in partitions])
+    ends = np.array([max(p.angles) for p in partitions])
+    startAngles = angle(directions, starts)
+    endAngles = angle(directions, ends)
+    minAngles = np.where(inWedge(directions, starts, ends), 0.0, np.minimum(startAngles, endAngles))
+    maxAngles = np.maximum(startAngles, endAngles)
+    # a facility at o makes no angle with anything
+    atO = ((dx == 0) & (dy == 0))[:, None]
+    return np.where(atO, 0.0, minAngles), np.where(atO, 0.0, maxAngles), np.sqrt(dx * dx + dy * dy)
+
+
+def pruneSpace(facilities, partitions):
+    # the facilities of one leaf against every partition at once
+    coords = np.array([f.coords for f in facilities], dtype=float).reshape(-1, 2)
+    minAngles, maxAngles, dists = getMinMaxAngles(partitions[0].o, coords, partitions)
+    with np.errstate(divide='ignore'):
+        upperRadii = np.where(maxAngles >= pi / 2, float('inf'), dists[:, None] / (2 * np.cos(maxAngles)))
+        lowerRadii = dists[:, None] / (2 * np.cos(minAngles))
+    relevant = minAngles < pi / 2
+    for j, partition in enumerate(partitions):
+        rows = np.flatnonzero(relevant[:, j])
+        if len(rows) == 0:
+            continue
+        partition.addUpperRadii(upperRadii[rows, j])
+        inside = partition.facilityUnprunedArea.containsPoints(coords[rows, 0], coords[rows, 1])
+        for i in rows[inside].tolist():
+            partition.sigList.append([float(lowerRadii[i, j]), facilities[i]])
 
 
-def filtering(q, k, index, partition_num):
-    partitions = getPartitions(q.geom, index, partition_num, k)
+def filtering(q, k, index, partition_num, control):
+    partitions = getPartitions(q.coords, index, partition_num, k)
+    x, y = q.coords
     h = MinHeap()
     h.push((0, index.root))
     while len(h) > 0:
+        control.visit()
         e_dist, e = h.pop()
         if not isPruned(e, [p.facilityUnprunedArea for p in partitions]):
-            if not e.is_data_node:
-                for child in e.children:
-                    h.push((child.geom.distance(q.geom), child))
+            if e.is_leaf_node:
+                facilities = [f for f in e.children if f != q]
+                control.load(e.children_num)
+                if len(facilities) > 0:
+                    pruneSpace(facilities, partitions)
             else:
-                if e != q:
-                    pruneSpace(e, partitions)
+                children = list(e.children)
+                control.load(len(children))
+                for child, child_dist in zip(children, mbr_min_dists(e.child_mbrs, x, y).tolist()):
+                    h.push((child_dist, child))
+    for partition in partitions:
+        partition.updateUnprunedArea(exact=True)
     return partitions
 
 
-def verification(q, k, index, partitions):
+def locatePartition(o, x, y, partitions):
+    # getPartitions slices the plane into equal angles counterclockwise from the x axis
+    a = atan2(y - o[1], x - o[0]) % (2 * pi)
+    return partitions[min(int(a / (2 * pi) * len(partitions)), len(partitions) - 1)]
+
+
+def verification(q, k, index, partitions, control):
     for partition in partitions:
-        partition.sigList.sort()
+        partition.sortSigList()
+    userUnprunedAreas = [p.userUnprunedArea for p in partitions]
     h = list()
     h.append(index.root)
     while len(h) > 0:
+        control.visit()
         e = h.pop()
-        if not isPruned(e, [p.userUnprunedArea for p in partitions]):
+        if not isPruned(e, userUnprunedAreas):
             if not e.is_data_node:
                 for child in e.children:
                     h.append(child)
+                control.load(e.children_num)
             else:
                 if q != e and isRkNN(e, k, partitions):
                     yield e
 
 
 def isRkNN(u, k, partitions):
-    for p in partitions:
-        if u.geom.intersects(p):
-            partition = p
-            break
-    count = 0
-    for lowerRadius, f in partition.sigList:
-        if f == u:
-            continue
-        dist = u.geom.distance(partition.o)
-        if dist <= lowerRadius:
-            return True
-        if u.geom.distance(f.geom) < dist:
-            count += 1
-            if count >= k:
-                return False
-    return True
+    x, y = u.coords
+    o = partitions[0].o
+    partition = locatePartition(o, x, y, partitions)
+    dist = distance(x, y, o[0], o[1])
+    # only facilities whose lower radius is below dist can be closer to u than q
+    end = bisect_left(partition.lowerRadii, dist)
+    if end < k:
+        return True
+    dx = partition.sigCoords[:end, 0] - x
+    dy = partition.sigCoords[:end, 1] - y
+    closer = np.sqrt(dx * dx + dy * dy) < dist
+    if u.tree is partition.sigTree:
+        closer &= partition.sigIds[:end] != u.id
+    return np.count_nonzero(closer) < k
 
 
-def BiRkNN(q, k, facility_index, user_index):
-    partitions = filtering(q, k, facility_index, 12)
-    return verification(q, k, user_index, partitions)
+def BiRkNN(q, k, facility_index, user_index, partition_num=12, control=None):
+    if control is None:
+        control = QueryControl()
+    partitions = filtering(q, k, facility_index, partitionNum(q, k, facility_index, partition_num), control)
+    return verification(q, k, user_index, partitions, control)
 
 
-def MonoRkNN(q, k, index):
-    partitions = filtering(q, k + 1, index, 12)
-    return verification(q, k, index, partitions)
+def MonoRkNN(q, k, index, partition_num=12, control=None):
+    if control is None:
+        control = QueryControl()
+    partitions = filtering(q, k + 1, index, partitionNum(q, k, index, partition_num), control)
+    return verification(q, k, index, partitions, control)
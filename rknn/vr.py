@@ -1,7 +1,14 @@
-from shapely.geometry import Point, Polygon, LineString
-from math import cos, pi, sin
+from shapely.geometry import Point, Polygon
+from math import atan2, cos, pi, sin
+from numbers import Integral
+
+import numpy as np
 
 from common.data_structure import MinHeap, NSmallestHolder
+from index.rtree import distance
+from index.vortree import SitePool
+from rknn.control import QueryControl
+from rknn.slice import clip, inWedge, segment_distance
 
 
 class DistanceCalculator:
@@ -50,9 +57,29 @@ class Sector(Polygon):
 
 
 class Partition(Sector):
+    # the pruning tests points and Voronoi edges against the partition arithmetically, the polygon is only kept for
+    # range queries
     def __init__(self, o, r, angles, k):
         Sector.__init__(self, o, r, angles)
         self.candidates = NSmallestHolder(k)
+        self.start, self.end = min(angles), max(angles)
+
+    def containsPoint(self, x, y):
+        dx = x - self.o.x
+        dy = y - self.o.y
+        if dx == 0 and dy == 0:
+            return True
+        return distance(dx, dy, 0, 0) <= self.r and inWedge(atan2(dy, dx), self.start, self.end, 1e-9)
+
+    def intersectsSegment(self, a, b):
+        # clip the segment to the wedge, widened by a rounding margin, and measure how far the rest is from o
+        ox, oy = self.o.x, self.o.y
+        margin = 1e-9 * self.r
+        segment = clip([a, b], -sin(self.start), cos(self.start), sin(self.start) * ox - cos(self.start) * oy + margin)
+        segment = clip(segment, sin(self.end), -cos(self.end), cos(self.end) * oy - sin(self.end) * ox + margin)
+        if len(segment) == 0:
+            return False
+        return min(segment_distance((ox, oy), segment[i - 1], segment[i]) for i in range(len(segment))) <= self.r
 
 
 def getPartitions(o, index, n, k):
@@ -61,52 +88,79 @@ def getPartitions(o, index, n, k):
     return [Partition(o, r, [2 * pi / n * i, 2 * pi / n * (i + 1)], k) for i in range(n)]
 
 
+def partitionNum(partition_num):
+    # the six-region pruning needs sectors of at most pi/3, and sweeps over k found no gain in going finer, so VR has
+    # no adaptive count
+    if not isinstance(partition_num, Integral) or partition_num < 6:
+        raise ValueError(f'partition_num must be an integer of at least 6, got {partition_num}')
+    return int(partition_num)
+
+
 def kNNRadius(q, k, index):
     if k == 0:
         return 0
+    r = index.precomputed_knn_radius(q, k)
+    if r is not None:
+        return r
     knn = list(index.nearest(q, k))
     return knn[-1][1]
 
 
 def isRkNN(e, q, k, facility_index):
-    if q.geom.distance(e.geom) <= kNNRadius(e, k, facility_index):
-        return True
-    else:
-        return False
+    if k == 0:
+        return q.geom.distance(e.geom) <= 0
+    dist = distance(*e.coords, *q.coords)
+    r = facility_index.precomputed_knn_radius(e, k)
+    if r is not None:
+        return dist <= r
+    # e is an RkNN of q iff fewer than k facilities are closer to e than q
+    return facility_index.count_closer_than(e, dist, k) < k
 
 
-def MonoPruning(q, k, index):
-    partitions = list(getPartitions(q.geom, index, 6, k))
+def MonoPruning(q, k, index, partition_num=6, control=None):
+    if control is None:
+        control = QueryControl()
+    partitions = list(getPartitions(q.geom, index, partitionNum(partition_num), k))
     for partition in partitions:
         partition.candidates = NSmallestHolder(k)
+    # Voronoi edges only matter to partitions that still have room for candidates
+    unfilled = list(partitions)
+    qx, qy = q.coords
     visited = {q}
     h = MinHeap()
     for neighbor in q.neighbors:
         h.push((1, neighbor))
         visited.add(neighbor)
+        control.load()
     while len(h) > 0:
+        control.visit()
         gd_p, p = h.pop()
+        x, y = p.coords
+        dist_p = distance(x, y, qx, qy)
         for partition in partitions:
-            if partition.intersects(p.geom):
+            if partition.containsPoint(x, y):
                 if partition.candidates.is_full():
                     dist_pn, pn = partition.candidates.largest()
                 else:
                     dist_pn = float('inf')
-                dist_p = p.geom.distance(q.geom)
                 if gd_p <= k and dist_p <= dist_pn:
                     partition.candidates.push((dist_p, p))
+                    if partition.candidates.is_full() and partition in unfilled:
+                        unfilled.remove(partition)
                     for neighbor in p.neighbors:
                         if neighbor not in visited:
                             visited.add(neighbor)
                             h.push((gd_p + 1, neighbor))
-        for neighbor in p.neighbors:
-            if gd_p <= k:
-                edge = LineString(list(neighbor.geom.coords)+list(p.geom.coords))
-                for partition in partitions:
-                    if not partition.candidates.is_full() and partition.intersects(edge):
-                        if neighbor not in visited:
+                            control.load()
+        if gd_p <= k and len(unfilled) > 0:
+            for neighbor in p.neighbors:
+                if neighbor not in visited:
+                    for partition in unfilled:
+                        if partition.intersectsSegment(neighbor.coords, (x, y)):
                             visited.add(neighbor)
                             h.push((gd_p + 1, neighbor))
+                            control.load()
+                            break
     visited = set()
     for partition in partitions:
         for dist_c, c in partition.candidates:
@@ -115,32 +169,44 @@ def MonoPruning(q, k, index):
                 yield c
 
 
-def BiPruning(q, k, facility_index, user_index):
-    partitions = list(getPartitions(q.geom, facility_index, 6, k))
+def BiPruning(q, k, facility_index, user_index, partition_num=6, control=None):
+    if control is None:
+        control = QueryControl()
+    partitions = list(getPartitions(q.geom, facility_index, partitionNum(partition_num), k))
     for partition in partitions:
         partition.candidates = list()
+    unfilled = list(partitions)
+    qx, qy = q.coords
     visited = {q}
     h = MinHeap()
     for neighbor in q.neighbors:
-        h.push((neighbor.geom.distance(q.geom), neighbor))
+        h.push((distance(*neighbor.coords, qx, qy), neighbor))
         visited.add(neighbor)
+        control.load()
     while len(h) > 0:
+        control.visit()
         dist_p, p = h.pop()
+        x, y = p.coords
         for partition in partitions:
-            if partition.intersects(p.geom):
+            if partition.containsPoint(x, y):
                 if len(partition.candidates) < k:
                     partition.candidates.append((dist_p, p))
+                    if len(partition.candidates) >= k:
+                        unfilled.remove(partition)
                     for neighbor in p.neighbors:
                         if neighbor not in visited:
                             visited.add(neighbor)
-                            h.push((neighbor.geom.distance(q.geom), neighbor))
-        for neighbor in p.neighbors:
-            edge = LineString(list(neighbor.geom.coords)+list(p.geom.coords))
-            for partition in partitions:
-                if len(partition.candidates) < k and partition.intersects(edge):
-                    if neighbor not in visited:
-                        visited.add(neighbor)
-                        h.push((neighbor.geom.distance(q.geom), neighbor))
+                            h.push((distance(*neighbor.coords, qx, qy), neighbor))
+                            control.load()
+        if len(unfilled) > 0:
+            for neighbor in p.neighbors:
+                if neighbor not in visited:
+                    for partition in unfilled:
+                        if partition.intersectsSegment(neighbor.coords, (x, y)):
+                            visited.add(neighbor)
+                            h.push((distance(*neighbor.coords, qx, qy), neighbor))
+                            control.load()
+                            break
 
     for partition in partitions:
         if len(partition.candidates) >= k:
@@ -149,23 +215,89 @@ def BiPruning(q, k, facility_index, user_index):
         else:
             unprunedArea = Sector(partition.o, partition.r, partition.angles)
         for e in user_index.intersects(unprunedArea):
+            control.visit()
+            control.load()
             yield e
 
 
-def verification(candidates, q, k, facility_index):
+def verification(candidates, q, k, facility_index, control):
+    # the candidates were counted as visited by the pruning
     for c in candidates:
+        control.check()
         if isRkNN(c, q, k, facility_index):
             yield c
 
 
-def MonoRkNN(q, k, index):
-    candidates = MonoPruning(q, k, index)
+def batchVerification(candidates, q, k, facility_index, control, chunk_size=512):
+    # c is an RkNN of q iff fewer than k facilities other than c are closer to c than q. The candidates are taken in
+    # chunks by distance from q and counted against one pool of facilities grown around q, a candidate is rejected as
+    # soon as k closer facilities are in the pool and accepted once the pool holds every facility that could be closer.
+    if k == 0:
+        yield from verification(candidates, q, k, facility_index, control)
+        return
+    qx, qy = q.coords
+    pending = []
+    for c in candidates:
+        control.check()
+        dist_c = distance(*c.coords, qx, qy)
+        r = facility_index.precomputed_knn_radius(c, k)
+        if r is None:
+            pending.append((dist_c, c))
+        elif dist_c <= r:
+            yield c
+    candidates = sorted(pending, key=lambda e: e[0])
+    pool = SitePool(facility_index, q)
+    for i in range(0, len(candidates), chunk_size):
+        chunk = candidates[i:i + chunk_size]
+        dists = np.array([dist_c for dist_c, c in chunk])
+        coords = np.array([c.coords for dist_c, c in chunk], dtype=float)
+        selves = np.array([pool.positions.get(c.id, -1) if c.tree is facility_index else -1 for dist_c, c in chunk])
+        # sites closer to c than q are closer to q than twice the distance between them
+        needed = 2 * dists * (1 + 1e-9)
+        counts = np.zeros(len(chunk), dtype=np.int64)
+        counted = 0
+        remaining = np.arange(len(chunk))
+        while len(remaining) > 0:
+            control.check()
+            sites = pool.coords[counted:]
+            if len(sites) > 0:
+                dx = coords[remaining, 0][:, None] - sites[:, 0][None, :]
+                dy = coords[remaining, 1][:, None] - sites[:, 1][None, :]
+                closer = np.sqrt(dx * dx + dy * dy) < dists[remaining][:, None]
+                own = selves[remaining] - counted
+                mine = (own >= 0) & (own < len(sites))
+                closer[np.flatnonzero(mine), own[mine]] = False
+                counts[remaining] += np.count_nonzero(closer, axis=1)
+                counted += len(sites)
+            rejected = counts[remaining] >= k
+            settled = rejected | pool.is_complete | (needed[remaining] < pool.radius)
+            for j in remaining[settled & ~rejected].tolist():
+                yield chunk[j][1]
+            remaining = remaining[~settled]
+            if len(remaining) > 0:
+                pool.grow(radius=float(needed[remaining].min()), count=2 * len(pool.positions))
+                # the candidate itself may only now have joined the pool
+                selves = np.array([pool.positions.get(c.id, -1) if c.tree is facility_index else -1
+                                   for dist_c, c in chunk])
+
 
-    for e in verification(candidates, q, k, index):
-        yield e
+def MonoRkNN(q, k, index, partition_num=6, batch=False, control=None):
+    if control is None:
+        control = QueryControl()
+    candidates = MonoPruning(q, k, index, partition_num, control)
+    if batch:
+        yield from batchVerification(candidates, q, k, index, control)
+    else:
+        for e in verification(candidates, q, k, index, control):
+            yield e
 
 
-def BiRkNN(q, k, facility_index, user_index):
-    candidates = BiPruning(q, k, facility_index, user_index)
-    for e in verification(candidates, q, k, facility_index):
-        yield e
+def BiRkNN(q, k, facility_index, user_index, partition_num=6, batch=False, control=None):
+    if control is None:
+        control = QueryControl()
+    candidates = BiPruning(q, k, facility_index, user_index, partition_num, control)
+    if batch:
+        yield from batchVerification(candidates, q, k, facility_index, control)
+    else:
+        for e in verification(candidates, q, k, facility_index, control):
+            yield e
@@ -54,6 +54,12 @@ if __name__ == '__main__':
     plot_single_distribution(time_cost, 'Effect-of-k-on-BiRkNN-time-cost(Real)', scale='log')
     plot_single_distribution(io_cost, 'Effect-of-k-on-BiRkNN-io-cost(Real)', scale='log')
 
+    # effect of number of partitions on Mono-RkNN
+    time_cost, io_cost = experiments.BenchmarkExperiments.evaluate_effect_of_partition_num_on_MonoRkNN(k=100,
+                                                                                                      distribution='Uniform')
+    plot_single_distribution(time_cost, 'Effect-of-partition-num-on-MonoRkNN-time-cost(k=100,Uniform)')
+    plot_single_distribution(io_cost, 'Effect-of-partition-num-on-MonoRkNN-io-cost(k=100,Uniform)')
+
     # effect of number of users relative to number of facilities
     time_cost, io_cost = experiments.BenchmarkExperiments.evaluate_effect_of_user_num_relative_to_facility_num(k=10)
     plot_dual_distribution(time_cost, 'Effect-of-user-relative-to-facility-on-BiRkNN-time-cost(k=10)')
@@ -0,0 +1,33 @@
+import numpy as np
+from shapely.geometry import Point
+
+
+def random_points(n, prefix, seed):
+    rng = np.random.default_rng(seed)
+    return [(f'{prefix}{i}', Point(x, y)) for i, (x, y) in enumerate(rng.uniform(0, 1, (n, 2)))]
+
+
+def brute_force_rknn(q_uuid, k, facilities, users=None):
+    # facilities and users map external ids to (x, y), a point is an RkNN of q when fewer than k facilities other
+    # than itself are strictly closer to it than q
+    points = facilities if users is None else users
+    qx, qy = facilities[q_uuid]
+    ids = list(facilities)
+    xy = np.array([facilities[uuid] for uuid in ids], dtype=float)
+    result = set()
+    for uuid, (x, y) in points.items():
+        if uuid == q_uuid and users is None:
+            continue
+        dist_q = np.sqrt((x - qx) ** 2 + (y - qy) ** 2)
+        dists = np.sqrt((xy[:, 0] - x) ** 2 + (xy[:, 1] - y) ** 2)
+        closer = int((dists < dist_q).sum())
+        if users is None and dist_q > 0:
+            # p itself is at distance 0 < dist_q
+            closer -= 1
+        if closer < k:
+            result.add(uuid)
+    return result
+
+
+def coordinates(points):
+    return {uuid: (p.x, p.y) for uuid, p in points}
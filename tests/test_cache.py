@@ -0,0 +1,63 @@
+import random
+
+from shapely.geometry import Point
+
+from helpers import brute_force_rknn, coordinates, random_points
+from index.vortree import VoRtreeIndex
+from rknn import csd
+from rknn.cache import RkNNCache
+
+facilities = random_points(1500, 'f', 1)
+users = random_points(1500, 'u', 2)
+
+
+def test_cached_results_match_brute_force():
+    facility_index = VoRtreeIndex(data=facilities)
+    user_index = VoRtreeIndex(data=users)
+    cache = RkNNCache(facility_index, user_index)
+    for q_uuid in random.Random(3).sample([uuid for uuid, p in facilities], 5):
+        q = facility_index.lookup(q_uuid)
+        for k in (1, 10):
+            mono = brute_force_rknn(q_uuid, k, coordinates(facilities))
+            bi = brute_force_rknn(q_uuid, k, coordinates(facilities), coordinates(users))
+            for algorithm in ('csd', 'slice', 'vr'):
+                assert {e.uuid for e in cache.MonoRkNN(q, k, algorithm)} == mono
+                assert {e.uuid for e in cache.MonoRkNN(q, k, algorithm, batch=True)} == mono
+                assert {e.uuid for e in cache.BiRkNN(q, k, algorithm)} == bi
+    assert cache.statistics['hits'] == 5 * 2 * 3
+
+
+def test_exact_query_after_approximate_one_is_not_served_from_the_cache():
+    facility_index = VoRtreeIndex(data=facilities)
+    user_index = VoRtreeIndex(data=users)
+    cache = RkNNCache(facility_index, user_index)
+    for q_uuid in random.Random(4).sample([uuid for uuid, p in facilities], 10):
+        q = facility_index.lookup(q_uuid)
+        list(cache.MonoRkNN(q, 10, approximation=csd.Approximation(sample_rate=0, seed=0)))
+        list(cache.BiRkNN(q, 10, approximation=csd.Approximation(sample_rate=0, seed=0)))
+        assert {e.uuid for e in cache.MonoRkNN(q, 10)} == brute_force_rknn(q_uuid, 10, coordinates(facilities))
+        assert {e.uuid for e in cache.BiRkNN(q, 10)} == brute_force_rknn(q_uuid, 10, coordinates(facilities),
+                                                                         coordinates(users))
+    assert cache.statistics['bypasses'] == 20
+    assert cache.statistics['hits'] == 0
+
+
+def test_updates_invalidate_cached_results():
+    points = facilities[:500]
+    index = VoRtreeIndex(data=points)
+    cache = RkNNCache(index)
+    expected = coordinates(points)
+    q = index.lookup('f0')
+    rng = random.Random(5)
+    for step in range(20):
+        assert {e.uuid for e in cache.MonoRkNN(q, 5)} == brute_force_rknn('f0', 5, expected)
+        if step % 2 == 0:
+            x, y = expected['f0']
+            uuid = f'g{step}'
+            expected[uuid] = (x + rng.uniform(-0.05, 0.05), y + rng.uniform(-0.05, 0.05))
+            index.insert(uuid, Point(*expected[uuid]))
+        else:
+            uuid = rng.choice(sorted(set(expected) - {'f0'}))
+            del expected[uuid]
+            index.delete(index.lookup(uuid))
+    assert cache.statistics['hits'] == 0
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+from shapely.geometry import Point
+
+from helpers import brute_force_rknn, coordinates, random_points
+from index.rtree import RtreeIndex
+from index.vortree import VoRtreeIndex
+from rknn import csd, slice, vr
+
+facilities = random_points(500, 'f', 41)
+users = random_points(500, 'u', 42)
+
+
+@pytest.fixture
+def frozen_indices(tmp_path):
+    VoRtreeIndex(data=facilities).freeze(str(tmp_path / 'f'))
+    VoRtreeIndex(data=users).freeze(str(tmp_path / 'u'))
+    facility_index = VoRtreeIndex(path=str(tmp_path / 'f'), cache_size=20)
+    user_index = VoRtreeIndex(path=str(tmp_path / 'u'), cache_size=20)
+    yield facility_index, user_index
+    facility_index.close()
+    user_index.close()
+
+
+def test_frozen_nodes_match_the_index_they_were_frozen_from(tmp_path):
+    index = VoRtreeIndex(data=facilities)
+    index.freeze(str(tmp_path / 'f'))
+    frozen = VoRtreeIndex(path=str(tmp_path / 'f'))
+    assert frozen.frozen and frozen.readonly
+    for i in range(index.properties.NEXT_ID):
+        assert (i in frozen.nodes) == (i in index.nodes)
+        if i in index.nodes:
+            assert frozen.nodes[i].to_data() == index.nodes[i].to_data()
+            assert frozen.neighbor_ids(i) == list(index.nodes[i].neighbor_ids or [])
+    assert frozen.lookup('f17').id == index.lookup('f17').id
+    assert 'f500' not in frozen.ids
+    assert vars(frozen.properties) == vars(index.properties)
+    frozen.close()
+
+
+@pytest.mark.parametrize('algorithm', [csd, slice, vr])
+def test_frozen_rknn_matches_brute_force(algorithm, frozen_indices):
+    facility_index, user_index = frozen_indices
+    for q_uuid in ('f0', 'f250', 'f499'):
+        q = facility_index.lookup(q_uuid)
+        for k in (1, 10):
+            assert ({e.uuid for e in algorithm.MonoRkNN(q, k, facility_index)} ==
+                    brute_force_rknn(q_uuid, k, coordinates(facilities)))
+            assert ({e.uuid for e in algorithm.BiRkNN(q, k, facility_index, user_index)} ==
+                    brute_force_rknn(q_uuid, k, coordinates(facilities), coordinates(users)))
+
+
+def test_frozen_indices_refuse_writes(frozen_indices):
+    facility_index, user_index = frozen_indices
+    with pytest.raises(ValueError):
+        facility_index.insert('g', Point(0.5, 0.5))
+    with pytest.raises(ValueError):
+        facility_index.delete(facility_index.lookup('f0'))
+    # the kNN radius table of a frozen index is kept in memory
+    facility_index.precompute_knn_radii([10])
+    q = facility_index.lookup('f3')
+    assert facility_index.precomputed_knn_radius(q, 10) == list(facility_index.nearest(q, 10))[-1][1]
+    assert not os.path.exists(facility_index.knn_path)
+
+
+def test_frozen_rtree_answers_like_the_original(tmp_path):
+    index = RtreeIndex(data=facilities, bulk_load=True)
+    index.freeze(str(tmp_path / 'r'))
+    frozen = RtreeIndex(path=str(tmp_path / 'r'))
+    for x, y in ((0.1, 0.2), (0.5, 0.5), (0.9, 0.05)):
+        assert ([(e.uuid, d) for e, d in sorted(frozen.nearest(Point(x, y), 5), key=lambda e: e[1])] ==
+                [(e.uuid, d) for e, d in sorted(index.nearest(Point(x, y), 5), key=lambda e: e[1])])
+    frozen.close()
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+from shapely.geometry import Point
+
+from helpers import brute_force_rknn, coordinates, random_points
+from index.vortree import VoRtreeIndex
+from rknn.monitor import RkNNMonitor
+
+
+@pytest.mark.parametrize('bichromatic', [False, True])
+def test_results_and_deltas_follow_brute_force(bichromatic):
+    facilities = coordinates(random_points(300, 'f', 51))
+    users = coordinates(random_points(300, 'u', 52)) if bichromatic else None
+    facility_index = VoRtreeIndex(data=[(uuid, Point(*xy)) for uuid, xy in facilities.items()])
+    user_index = VoRtreeIndex(data=[(uuid, Point(*xy)) for uuid, xy in users.items()]) if bichromatic else None
+    monitor = RkNNMonitor(facility_index, user_index)
+    queries = {monitor.register(q_uuid, k): (q_uuid, k) for q_uuid, k in (('f0', 1), ('f1', 4), ('f2', 10))}
+    results = {query_id: monitor.result(query_id) for query_id in queries}
+    rng = random.Random(53)
+
+    def near():
+        # events near the query facilities, where they change the results
+        x, y = facilities[rng.choice([q_uuid for q_uuid, k in queries.values()] or ['f3'])]
+        return x + rng.gauss(0, 0.03), y + rng.gauss(0, 0.03)
+
+    for step in range(120):
+        event = rng.randrange(6 if bichromatic else 3)
+        if event == 0:
+            uuid = f'g{step}'
+            facilities[uuid] = near()
+            deltas = monitor.insert_facility(uuid, Point(*facilities[uuid]))
+        elif event == 1:
+            uuid = rng.choice(sorted(set(facilities) - {'f0'}))
+            del facilities[uuid]
+            deltas = monitor.delete_facility(uuid)
+        elif event == 2:
+            uuid = rng.choice(sorted(facilities))
+            facilities[uuid] = near()
+            deltas = monitor.move_facility(uuid, Point(*facilities[uuid]))
+        elif event == 3:
+            uuid = f'v{step}'
+            users[uuid] = near()
+            deltas = monitor.insert_user(uuid, Point(*users[uuid]))
+        elif event == 4:
+            uuid = rng.choice(sorted(users))
+            del users[uuid]
+            deltas = monitor.delete_user(uuid)
+        else:
+            uuid = rng.choice(sorted(users))
+            users[uuid] = near()
+            deltas = monitor.move_user(uuid, Point(*users[uuid]))
+        for query_id, (q_uuid, k) in list(queries.items()):
+            if q_uuid not in facilities:
+                del queries[query_id]
+                assert query_id not in monitor.queries
+                continue
+            added, removed = deltas.get(query_id, (set(), set()))
+            assert not added & removed
+            results[query_id] = (results[query_id] | added) - removed
+            expected = brute_force_rknn(q_uuid, k, facilities, users)
+            assert monitor.result(query_id) == expected
+            assert results[query_id] == expected
+
+
+def test_user_events_need_a_user_index():
+    index = VoRtreeIndex(data=random_points(10, 'f', 54))
+    with pytest.raises(ValueError):
+        RkNNMonitor(index).insert_user('u', Point(0.5, 0.5))
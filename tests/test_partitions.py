@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+
+from helpers import brute_force_rknn, coordinates, random_points
+from index.vortree import VoRtreeIndex
+from rknn import slice, vr
+
+facilities = random_points(600, 'f', 11)
+users = random_points(600, 'u', 12)
+
+
+@pytest.mark.parametrize('algorithm, partition_num', [(slice, 3), (slice, np.int64(8)), (slice, 'auto'),
+                                                      (vr, 6), (vr, np.int32(9))])
+def test_partition_counts_match_brute_force(algorithm, partition_num):
+    facility_index = VoRtreeIndex(data=facilities)
+    user_index = VoRtreeIndex(data=users)
+    for q_uuid in ('f0', 'f1', 'f2'):
+        q = facility_index.lookup(q_uuid)
+        for k in (1, 10, 100):
+            assert ({e.uuid for e in algorithm.MonoRkNN(q, k, facility_index, partition_num=partition_num)} ==
+                    brute_force_rknn(q_uuid, k, coordinates(facilities)))
+            assert ({e.uuid for e in algorithm.BiRkNN(q, k, facility_index, user_index, partition_num=partition_num)} ==
+                    brute_force_rknn(q_uuid, k, coordinates(facilities), coordinates(users)))
+
+
+@pytest.mark.parametrize('algorithm, partition_num', [(slice, 2), (slice, 4.0), (vr, 5), (vr, 'auto')])
+def test_invalid_partition_counts_are_rejected(algorithm, partition_num):
+    index = VoRtreeIndex(data=facilities)
+    with pytest.raises(ValueError):
+        list(algorithm.MonoRkNN(index.lookup('f0'), 10, index, partition_num=partition_num))
@@ -0,0 +1,78 @@
+import pickle
+import random
+import struct
+
+import numpy as np
+import pytest
+from shapely.geometry import Point, box
+
+from common.persistence import PersistentDict
+from helpers import random_points
+from index.rtree import LEGACY_NODE_HEADER, RtreeIndex, decode_node, encode_node, legacy_data, new_ids
+
+
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_queries_after_inserts_and_deletes_match_brute_force(on_disk, tmp_path):
+    path = str(tmp_path / 'r') if on_disk else None
+    index = RtreeIndex(data=random_points(200, 'p', 31), path=path, max_children_num=5, min_children_num=2,
+                       cache_size=20 if on_disk else None)
+    live = dict(random_points(200, 'p', 31))
+    rng = random.Random(32)
+    for step in range(300):
+        if rng.random() < 0.5:
+            uuid = f'g{step}'
+            live[uuid] = Point(rng.random(), rng.random())
+            index.insert(uuid, live[uuid])
+        else:
+            uuid = rng.choice(sorted(live))
+            del live[uuid]
+            index.delete(index.lookup(uuid))
+        if step % 25 == 0:
+            x, y = rng.random(), rng.random()
+            expected = sorted(np.hypot(p.x - x, p.y - y) for p in live.values())[:7]
+            assert sorted(d for e, d in index.nearest(Point(x, y), 7)) == pytest.approx(expected)
+            area = box(x - 0.2, y - 0.2, x + 0.2, y + 0.2)
+            assert {e.uuid for e in index.intersects(area)} == {u for u, p in live.items() if area.intersects(p)}
+
+
+def test_node_records_round_trip():
+    rng = random.Random(33)
+    for i in range(200):
+        coords = rng.choice([None, (rng.random(), rng.random()), tuple(rng.random() for j in range(4))])
+        child_ids = rng.choice([None, new_ids(rng.randrange(2 ** 40) for j in range(rng.randrange(12)))])
+        neighbor_ids = rng.choice([None, new_ids(rng.randrange(2 ** 40) for j in range(rng.randrange(12)))])
+        uuid = rng.choice([None, '', f'ü-{i}'])
+        level = rng.randrange(8)
+        assert decode_node(encode_node(coords, child_ids, level, uuid, neighbor_ids)) == \
+            (coords, child_ids, level, uuid, neighbor_ids)
+
+
+def test_on_disk_index_matches_the_in_memory_one(tmp_path):
+    data = random_points(300, 'p', 34)
+    memory = RtreeIndex(data=data)
+    disk = RtreeIndex(data=data, path=str(tmp_path / 'r'))
+    disk.close()
+    disk = RtreeIndex(path=str(tmp_path / 'r'), readonly=True, cache_size=10)
+    assert disk.properties.NEXT_ID == memory.properties.NEXT_ID
+    for i in range(memory.properties.NEXT_ID):
+        assert (i in disk.nodes) == (i in memory.nodes)
+        if i in memory.nodes:
+            assert disk.nodes[i].to_data() == memory.nodes[i].to_data()
+    assert disk.lookup('p7').id == memory.lookup('p7').id
+
+
+def test_legacy_indices_are_rebuilt_from_their_points(tmp_path):
+    # an index keyed by uuids, with a pickled root and data node and a data node in node record format 1
+    path = str(tmp_path / 'legacy')
+    database = PersistentDict(path)
+    properties = RtreeIndex.Properties(10, 5, 'root', 0)
+    del properties.NEXT_ID, properties.VERSION
+    database['properties'] = properties
+    database.set_bytes('root', pickle.dumps((box(0, 0, 1, 1), ['a', 'b'], 1, None)))
+    database.set_bytes('a', pickle.dumps((Point(0.25, 0.5), None, 0, ['b'])))
+    database.set_bytes('b', LEGACY_NODE_HEADER.pack(1, 0, 2, 0, 0xFFFFFFFF, 1) + struct.pack('<2d', 0.75, 1) + b'a')
+    database.close()
+    with pytest.raises(ValueError):
+        RtreeIndex(path=path, readonly=True).root
+    data = sorted((uuid, (geom.x, geom.y)) for uuid, geom in legacy_data(path))
+    assert data == [('a', (0.25, 0.5)), ('b', (0.75, 1.0))]
@@ -0,0 +1,86 @@
+import random
+
+import numpy as np
+import pytest
+from scipy.spatial import Voronoi
+from shapely.geometry import Point
+
+from helpers import brute_force_rknn, random_points
+from index.vortree import VoRtreeIndex
+from rknn import csd
+
+
+def voronoi_edges(index):
+    nodes = index.data_nodes()
+    ridges = Voronoi([node.coords for node in nodes]).ridge_points
+    return {(min(nodes[a].id, nodes[b].id), max(nodes[a].id, nodes[b].id)) for a, b in ridges}
+
+
+def neighbor_edges(index):
+    nodes = index.data_nodes()
+    for node in nodes:
+        for neighbor_id in node.neighbor_ids:
+            assert node.id in index.nodes[neighbor_id].neighbor_ids
+    return {(min(node.id, neighbor_id), max(node.id, neighbor_id)) for node in nodes for neighbor_id in node.neighbor_ids}
+
+
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_incremental_updates_match_a_rebuilt_diagram(on_disk, tmp_path):
+    path = str(tmp_path / 'f') if on_disk else None
+    index = VoRtreeIndex(data=random_points(300, 'f', 21), path=path, cache_size=50 if on_disk else None)
+    live = {node.uuid: node.coords for node in index.data_nodes()}
+    rng = random.Random(22)
+    for step in range(150):
+        if rng.random() < 0.5:
+            uuid = f'g{step}'
+            # some sites land outside the hull, which changes it
+            live[uuid] = (rng.uniform(-0.5, 1.5), rng.uniform(-0.5, 1.5)) if rng.random() < 0.15 else \
+                (rng.random(), rng.random())
+            index.insert(uuid, Point(*live[uuid]))
+        else:
+            uuid = rng.choice(sorted(live))
+            del live[uuid]
+            index.delete(index.lookup(uuid))
+        if step % 10 == 0:
+            assert neighbor_edges(index) == voronoi_edges(index)
+    assert neighbor_edges(index) == voronoi_edges(index)
+    for q_uuid in rng.sample(sorted(live), 5):
+        assert {e.uuid for e in csd.MonoRkNN(index.lookup(q_uuid), 5, index)} == brute_force_rknn(q_uuid, 5, live)
+
+
+@pytest.mark.parametrize('bulk_load', [False, True])
+def test_updates_of_tiny_indices(bulk_load):
+    index = VoRtreeIndex(data=random_points(2, 'f', 23), bulk_load=bulk_load)
+    live = {node.uuid: node.coords for node in index.data_nodes()}
+    for i, (x, y) in enumerate(np.random.default_rng(24).uniform(0, 1, (6, 2))):
+        index.insert(f'g{i}', Point(x, y))
+        live[f'g{i}'] = (x, y)
+    for uuid in sorted(live)[:5]:
+        index.delete(index.lookup(uuid))
+        del live[uuid]
+        nodes = index.data_nodes()
+        if len(nodes) >= 4:
+            assert neighbor_edges(index) == voronoi_edges(index)
+        for node in nodes:
+            x, y = live[node.uuid]
+            expected = sorted(np.hypot(x - ox, y - oy) for uuid, (ox, oy) in live.items() if uuid != node.uuid)
+            assert [d for n, d in index.nearest(node, len(nodes) - 1)] == pytest.approx(expected)
+    assert {node.uuid for node in index.data_nodes()} == set(live)
+
+
+def test_knn_radius_table_survives_refused_writes_and_goes_stale_on_updates(tmp_path):
+    path = str(tmp_path / 'f')
+    index = VoRtreeIndex(data=random_points(300, 'f', 25), path=path)
+    index.precompute_knn_radii([1, 10])
+    index.close()
+    readonly = VoRtreeIndex(path=path, readonly=True)
+    with pytest.raises(OSError):
+        readonly.insert('g', Point(0.5, 0.5))
+    readonly.close()
+    index = VoRtreeIndex(path=path)
+    q = index.lookup('f5')
+    assert index.precomputed_knn_radius(q, 10) == list(index.nearest(q, 10))[-1][1]
+    index.insert('g', Point(*q.coords))
+    assert index.precomputed_knn_radius(q, 10) is None
+    index.close()
+    assert VoRtreeIndex(path=path).knn_table is None